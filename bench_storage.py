@@ -0,0 +1,57 @@
+# قياس المسارات الساخنة لمخزن البيانات محلياً ومقارنة التطبيقات:
+#   STORAGE_BACKEND=sqlite python bench_storage.py
+#   STORAGE_BACKEND=postgres DATABASE_URL=postgresql://... python bench_storage.py
+# يكتب صفوفاً تجريبية، فاستخدم قاعدة بيانات للتجربة فقط وليس قاعدة الإنتاج.
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("WEBHOOK_URL", "https://example.invalid/webhook")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+
+import bot
+
+N = int(os.environ.get("BENCH_N", 20000))
+BASE_ID = 9_000_000_000
+
+def measure(label, fn, count):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {count:>8} ops  {elapsed:8.3f}s  {count / elapsed if elapsed else 0:>12.0f} ops/s")
+
+def save_users():
+    for i in range(N):
+        bot.save_user(BASE_ID + i)
+    bot.users_buffer.flush()
+
+def bans():
+    for i in range(0, N, 10):
+        bot.ban_user(BASE_ID + i, duration=60)
+
+def is_banned():
+    for i in range(N):
+        bot.is_banned(BASE_ID + i)
+
+def has_joined():
+    for i in range(N // 10):
+        bot.storage.has_joined(BASE_ID + i)
+
+def stats():
+    for _ in range(20):
+        bot.storage.stats(bot.datetime.utcnow())
+
+def export():
+    for kind in ("users", "banned"):
+        for _ in bot.storage.export_batches(kind, bot.EXPORT_BATCH_SIZE):
+            pass
+
+print(f"backend: {bot.storage.name}")
+measure("save_user + flush", save_users, N)
+measure("ban_user", bans, N // 10)
+measure("is_banned", is_banned, N)
+measure("has_joined (storage)", has_joined, N // 10)
+measure("stats", stats, 20)
+measure("export users+banned", export, 2)
+for key, value in bot.storage.metrics().items():
+    print(f"{key}: {value}")
@@ -1,20 +1,41 @@
 import os
+import sys
 import time
+import math
 import tempfile
 import io
 import re
+import html
 import csv
+import gzip
+import uuid
+import shutil
+import hashlib
 import logging
 import threading
+import signal
+import atexit
+import queue
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import recv_handle
+import heapq
+from abc import ABC, abstractmethod
+import sqlite3
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from flask import Flask, request
+from flask import Flask, request, jsonify
 import telebot
 from telebot import types
-import yt_dlp
+import media_worker
+from media_worker import DownloadTooLarge, format_size
 from PIL import Image
 import pytesseract
-from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.extras import RealDictCursor, execute_values
+import psycopg2
+from psycopg2.pool import PoolError
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 # ===== Logging =====
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -24,140 +45,1069 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 CHANNEL_USERNAME = os.environ.get("CHANNEL_USERNAME", "aie_tool_channel") # بدون @
 PORT = int(os.environ.get("PORT", 10000))
+# خادم Bot API مستضاف ذاتياً (مثل http://localhost:8081) يقبل رفع ملفات حتى 2GB؛ فارغ للخادم العام
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+# الخادم الذاتي يعمل بـ --local ويقرأ MEDIA_CACHE_DIR من نفس القرص: نرسل له مسار الملف
+# (file://) بدل محتواه، فلا يُحمَّل الملف في ذاكرة البوت أثناء الرفع
+TELEGRAM_API_LOCAL = os.environ.get("TELEGRAM_API_LOCAL", "0") == "1"
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN غير معرف في متغيرات البيئة")
 if not WEBHOOK_URL:
     raise RuntimeError("WEBHOOK_URL غير معرف في متغيرات البيئة")
+if TELEGRAM_API_LOCAL and not TELEGRAM_API_URL:
+    raise RuntimeError("TELEGRAM_API_LOCAL يتطلب TELEGRAM_API_URL لخادم Bot API يعمل بـ --local")
 
 OWNER_ID = int(os.environ.get("OWNER_ID", "5883400070"))
 BAN_DURATION = 5 * 60 # 5 دقائق
 
+# ===== إعدادات معالجة التحديثات =====
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8)) # عدد العمال
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 100)) # عمق الطابور لكل عامل
+UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", 600)) # ثواني تذكّر update_id
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", 20000))
+
+# ===== حدود المعدل لكل مستخدم (السعة/الثواني لملء الدلو كاملاً) =====
+RATE_LIMITS = {
+    "metadata": os.environ.get("RATE_METADATA", "6/60"),
+    "download": os.environ.get("RATE_DOWNLOAD", "3/60"),
+    "ocr": os.environ.get("RATE_OCR", "3/60"),
+    "export": os.environ.get("RATE_EXPORT", "2/60"),
+}
+# حدود مشتركة لكل المستخدمين ولا يُستثنى منها المالك: التصدير أوامر للمالك وحده،
+# والهدف حماية قاعدة البيانات من تصديرات متلاحقة وليس تقسيم الرصيد بين المستخدمين
+RATE_GLOBAL_ACTIONS = {"export"}
+RATE_MAX_BUCKETS = int(os.environ.get("RATE_MAX_BUCKETS", 50000))
+
+# ===== كاش عضوية القناة =====
+MEMBERSHIP_TTL = int(os.environ.get("MEMBERSHIP_TTL", 300)) # ثواني للعضو
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_NEGATIVE_TTL", 30)) # ثواني لغير العضو
+MEMBERSHIP_EVENTS_TTL = int(os.environ.get("MEMBERSHIP_EVENTS_TTL", 6 * 60 * 60)) # صلاحية الحالة عندما تصل أحداث chat_member (احتياط لحدث ضائع)
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", 50000))
+
+BAN_SWEEP_INTERVAL = int(os.environ.get("BAN_SWEEP_INTERVAL", 60)) # ثواني بين كل تنظيف للحظر المنتهي
+
+# ===== الكتابة المؤجلة لجداول users و joined_users =====
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", 5)) # ثواني
+WRITE_FLUSH_SIZE = int(os.environ.get("WRITE_FLUSH_SIZE", 500)) # تفريغ فوري عند هذا العدد
+WRITE_SEEN_SIZE = int(os.environ.get("WRITE_SEEN_SIZE", 200000)) # معرفات نعرف أنها محفوظة
+
+STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", 60)) # ثواني صلاحية نتيجة /stats
+
+# ===== جلسات المستخدمين =====
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 20000)) # أقصى عدد جلسات في الذاكرة
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", 6 * 60 * 60)) # حذف الجلسة بعد هذا الخمول (ثواني)
+
+# ===== كاش بيانات الوسائط (نتيجة extract_info) =====
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 64))
+METADATA_WORKERS = int(os.environ.get("METADATA_WORKERS", 4)) # خيوط استخراج البيانات في الخلفية بعد الرد على الرابط
+METADATA_TTL = int(os.environ.get("METADATA_TTL", 10 * 60)) # روابط الصيغ تنتهي صلاحيتها، فلا نطيلها
+
+# ===== جودة التحميل (جزء من مفتاح كاش file_id) =====
+VIDEO_FORMAT = os.environ.get("VIDEO_FORMAT", "best") # صيغة yt-dlp للفيديو
+AUDIO_FORMAT = os.environ.get("AUDIO_FORMAT", "bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best") # صيغة yt-dlp للصوت
+# امتدادات تُرسل كما هي بدون تحويل، أو "مصدر>هدف" لتغيير الحاوية فقط: mp4>m4a ينسخ صوت AAC
+# من فيديو mp4 (كل صيغ تيك توك) إلى m4a بدون إعادة ترميز
+AUDIO_PASSTHROUGH = [ext.strip() for ext in os.environ.get("AUDIO_PASSTHROUGH", "m4a,mp3,mp4>m4a").split(",") if ext.strip()]
+AUDIO_CODEC = os.environ.get("AUDIO_CODEC", "mp3") # الصيغة الهدف عند الحاجة للتحويل
+AUDIO_QUALITY = os.environ.get("AUDIO_QUALITY", "192") # معدل التحويل بالكيلوبت (أو 0-10 لجودة VBR)
+AUDIO_SOURCE_RATIO = float(os.environ.get("AUDIO_SOURCE_RATIO", 10)) # أقصى حجم للمصدر عند تحميل صوت كمضاعف لحد الملف الناتج
+# أكبر ملف نرسله. حد الخادم العام 50MB والخادم الذاتي 2000MB، لكن الرفع العادي (multipart عبر
+# requests) يقرأ الملف كاملاً في الذاكرة ثم ينسخه في جسم الطلب، أي قرابة ضعف حجمه من RAM.
+# لذلك 2000MB افتراضياً فقط مع TELEGRAM_API_LOCAL، و200MB لخادم ذاتي بدونه؛ رفع الحد يتطلب ذاكرة تكفيه
+if TELEGRAM_API_LOCAL:
+    UPLOAD_DEFAULT_MB = 1990
+elif TELEGRAM_API_URL:
+    UPLOAD_DEFAULT_MB = 200
+else:
+    UPLOAD_DEFAULT_MB = 45
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", UPLOAD_DEFAULT_MB * 1024 * 1024))
+UPLOAD_TIMEOUT = int(os.environ.get("UPLOAD_TIMEOUT", 10 * 60)) # ثواني انتظار رفع ملف واحد إلى تيليجرام
+AUDIO_SPLIT = os.environ.get("AUDIO_SPLIT", "0") == "1" # صوت أكبر من الحد يُقسّم ويُرسل كمجموعة وسائط بدل رفضه
+AUDIO_SPLIT_MAX_PARTS = min(int(os.environ.get("AUDIO_SPLIT_MAX_PARTS", 10)), 10) # مجموعة الوسائط تقبل 10 عناصر كحد أقصى
+FILE_ID_CACHE_SIZE = int(os.environ.get("FILE_ID_CACHE_SIZE", 5000)) # مفاتيح file_id في الذاكرة أمام قاعدة البيانات
+
+# ===== كاش الوسائط على القرص =====
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "media_cache"))
+MEDIA_CACHE_BYTES = int(os.environ.get("MEDIA_CACHE_BYTES", 1024 * 1024 * 1024)) # 0 لتعطيل الكاش
+
+# ===== جدولة التحميلات =====
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 2)) # أقصى عدد تحميلات متزامنة
+DOWNLOAD_USER_RUNNING = int(os.environ.get("DOWNLOAD_USER_RUNNING", 1)) # تحميلات متزامنة لكل مستخدم
+DOWNLOAD_USER_PENDING = int(os.environ.get("DOWNLOAD_USER_PENDING", 3)) # أقصى طلبات (منتظرة + جارية) لكل مستخدم
+MEDIA_PROCESSES = int(os.environ.get("MEDIA_PROCESSES", DOWNLOAD_WORKERS + 2)) # عمليات yt-dlp/ffmpeg (تحميل + استخراج بيانات)
+MEDIA_WORKER_MAX_JOBS = int(os.environ.get("MEDIA_WORKER_MAX_JOBS", 20)) # تُستبدل العملية بعد هذا العدد من المهام
+EXTRACT_TIMEOUT = float(os.environ.get("EXTRACT_TIMEOUT", 60)) # ثواني قبل قتل عملية استخراج معلّقة
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 15 * 60)) # ثواني قبل قتل عملية تحميل أو تحويل
+CANCEL_POLL_INTERVAL = 0.5 # ثواني بين فحوص طلب الإلغاء أثناء انتظار عملية التحميل
+DOWNLOAD_POSITION_UPDATES = int(os.environ.get("DOWNLOAD_POSITION_UPDATES", 10)) # عدد المنتظرين الذين نحدّث ترتيبهم
+BATCH_MAX_LINKS = int(os.environ.get("BATCH_MAX_LINKS", 20)) # أقصى روابط في رسالة أو ملف نصي واحد
+BATCH_FILE_MAX_BYTES = int(os.environ.get("BATCH_FILE_MAX_BYTES", 64 * 1024)) # أكبر ملف روابط .txt نقبله
+STATUS_EDIT_INTERVAL = float(os.environ.get("STATUS_EDIT_INTERVAL", 3)) # أقل فاصل (ثواني) بين تعديلين لرسائل الحالة في نفس المحادثة
+
+# ===== التصدير =====
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 5000)) # صفوف لكل دفعة من المؤشر
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_BYTES", 45 * 1024 * 1024)) # حد حجم الملف الواحد (تيليجرام 50MB)
+
 # ===== إعداد قاعدة البيانات =====
+# postgres (الافتراضي) أو sqlite للتجربة وقياس الأداء محلياً بدون خادم Postgres
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres").lower()
 DATABASE_URL = os.environ.get("DATABASE_URL")
-if not DATABASE_URL:
+SQLITE_PATH = os.environ.get("SQLITE_PATH", ":memory:")
+if STORAGE_BACKEND == "postgres" and not DATABASE_URL:
     raise RuntimeError("DATABASE_URL غير معرف. ضع رابط الاتصال في متغير البيئة DATABASE_URL")
 
 DB_MIN_CONN = 1
-DB_MAX_CONN = 6
-pool = SimpleConnectionPool(DB_MIN_CONN, DB_MAX_CONN, DATABASE_URL, cursor_factory=RealDictCursor, sslmode='require')
-
-def get_db_conn():
-    return pool.getconn()
-
-def put_db_conn(conn):
-    pool.putconn(conn)
-
-def init_db():
-    sql = """
-    CREATE TABLE IF NOT EXISTS users (
-    user_id BIGINT PRIMARY KEY,
-    first_seen TIMESTAMP DEFAULT now()
-    );
-    CREATE TABLE IF NOT EXISTS joined_users (
-    user_id BIGINT PRIMARY KEY,
-    joined_at TIMESTAMP DEFAULT now()
-    );
-    CREATE TABLE IF NOT EXISTS bans (
-    user_id BIGINT PRIMARY KEY,
-    ban_until TIMESTAMP
-    );
-    """
-    conn = get_db_conn()
-    try:
-        with conn:
+DB_MAX_CONN = int(os.environ.get("DB_MAX_CONN", 6))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", 10)) # ثواني انتظار اتصال متاح
+DB_PING_IDLE = float(os.environ.get("DB_PING_IDLE", 30)) # فحص الاتصال بـ SELECT 1 إذا بقي خاملاً أكثر من هذا
+
+class DBPool:
+    # بديل آمن للخيوط عن SimpleConnectionPool: ينتظر اتصالاً متاحاً بدل رمي خطأ،
+    # يفحص الاتصال قبل تسليمه ويعيد الاتصال بدل تسليم اتصال SSL مقطوع.
+    def __init__(self, minconn, maxconn, dsn, acquire_timeout, ping_idle, **kwargs):
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.kwargs = kwargs
+        self.acquire_timeout = acquire_timeout
+        self.ping_idle = ping_idle
+        self.idle = []
+        self.in_use = 0
+        self.cond = threading.Condition()
+        self.opened = 0
+        self.reconnects = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for _ in range(minconn):
+            self.idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.kwargs)
+        with self.cond:
+            self.opened += 1
+        return conn
+
+    def _is_alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.ping_idle:
+            return True
+        try:
             with conn.cursor() as cur:
-                cur.execute(sql)
-    finally:
-        put_db_conn(conn)
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self.cond:
+            while not self.idle and self.in_use >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolError("انتهت مهلة انتظار اتصال بقاعدة البيانات")
+                self.cond.wait(remaining)
+            entry = self.idle.pop() if self.idle else None
+            self.in_use += 1
+            waited = time.monotonic() - start
+            self.waits += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        try:
+            if entry is not None:
+                conn, idle_since = entry
+                if self._is_alive(conn, idle_since):
+                    return conn
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                with self.cond:
+                    self.reconnects += 1
+            return self._connect()
+        except Exception:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self.cond:
+            self.in_use -= 1
+            if not discard and not conn.closed:
+                self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "max": self.maxconn,
+                "opened": self.opened,
+                "reconnects": self.reconnects,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": f"{(self.wait_total / self.waits * 1000) if self.waits else 0:.1f}",
+                "max_wait_ms": f"{self.wait_max * 1000:.1f}",
+            }
+
+# ===== واجهة التخزين =====
+EXPORT_QUERIES = {
+    "users": "SELECT user_id, first_seen FROM users ORDER BY first_seen DESC",
+    "banned": "SELECT user_id, ban_until FROM bans ORDER BY ban_until DESC",
+    "joined": "SELECT user_id, joined_at FROM joined_users ORDER BY joined_at DESC",
+}
+
+class Storage(ABC):
+    # العمليات التي يحتاجها البوت من مخزن البيانات؛ كل تطبيق يوفرها بطريقته
+    name = None
+
+    @abstractmethod
+    def init(self):
+        ...
+
+    @abstractmethod
+    def load_bans(self):
+        ...
+
+    @abstractmethod
+    def upsert_ban(self, user_id, ban_until):
+        ...
+
+    @abstractmethod
+    def delete_ban(self, user_id):
+        ...
+
+    @abstractmethod
+    def delete_expired_bans(self, user_ids, now_ts):
+        ...
+
+    @abstractmethod
+    def insert_users(self, rows):
+        ...
+
+    @abstractmethod
+    def insert_joined_users(self, rows):
+        ...
+
+    @abstractmethod
+    def has_joined(self, user_id):
+        ...
+
+    @abstractmethod
+    def stats(self, now_ts):
+        ...
+
+    @abstractmethod
+    def export_batches(self, kind, batch_size):
+        ...
+
+    @abstractmethod
+    def get_file_id(self, media_key, action, quality):
+        ...
+
+    @abstractmethod
+    def put_file_id(self, media_key, action, quality, file_id, file_size):
+        ...
+
+    @abstractmethod
+    def delete_file_id(self, media_key, action, quality, file_id):
+        ...
+
+    def metrics(self):
+        return {}
+
+# ===== ترحيلات المخطط (تُطبّق مرة واحدة وبالترتيب) =====
+# الفهارس تُنشأ بـ CONCURRENTLY حتى لا تُقفل الجداول على النسخ العاملة حالياً
+MIGRATION_LOCK_ID = 724001
+SCHEMA_INDEXES = [
+    (1, "idx_users_first_seen", "users (first_seen)"),
+    (2, "idx_bans_ban_until", "bans (ban_until)"),
+    (3, "idx_joined_users_joined_at", "joined_users (joined_at)"),
+]
+
+STATS_SQL = """
+SELECT
+    COUNT(*) AS total_users,
+    COUNT(*) FILTER (WHERE first_seen >= %(last_24h)s) AS new_24h,
+    COUNT(*) FILTER (WHERE first_seen >= %(last_7d)s) AS new_7d,
+    (SELECT COUNT(*) FROM joined_users) AS joined_total,
+    (SELECT COUNT(*) FROM bans WHERE ban_until > %(now_ts)s) AS banned_now
+FROM users
+"""
+
+class PostgresStorage(Storage):
+    name = "postgres"
+
+    def __init__(self, dsn):
+        self.pool = DBPool(DB_MIN_CONN, DB_MAX_CONN, dsn, DB_ACQUIRE_TIMEOUT, DB_PING_IDLE, cursor_factory=RealDictCursor, sslmode='require')
+
+    def init(self):
+        sql = """
+        CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        first_seen TIMESTAMP DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS joined_users (
+        user_id BIGINT PRIMARY KEY,
+        joined_at TIMESTAMP DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS bans (
+        user_id BIGINT PRIMARY KEY,
+        ban_until TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS media_files (
+        media_key TEXT NOT NULL,
+        action TEXT NOT NULL,
+        quality TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        file_size BIGINT,
+        created_at TIMESTAMP DEFAULT now(),
+        PRIMARY KEY (media_key, action, quality)
+        );
+        """
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql)
+        self.run_migrations()
+
+    def run_migrations(self):
+        with self.pool.connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    # قفل استشاري يمنع نسختين من تطبيق الترحيلات معاً أثناء النشر
+                    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                    try:
+                        cur.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        applied_at TIMESTAMP DEFAULT now()
+                        )
+                        """)
+                        cur.execute("SELECT version FROM schema_migrations")
+                        applied = {r['version'] for r in cur.fetchall()}
+                        for version, name, target in SCHEMA_INDEXES:
+                            if version in applied:
+                                continue
+                            # فهرس CONCURRENTLY فشل سابقاً يبقى INVALID، فنحذفه ونعيد بناءه
+                            cur.execute(
+                                "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s",
+                                (name,)
+                            )
+                            row = cur.fetchone()
+                            if row and not row['indisvalid']:
+                                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                            cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target}")
+                            cur.execute("INSERT INTO schema_migrations (version) VALUES (%s) ON CONFLICT DO NOTHING", (version,))
+                            logging.info("applied migration %s (%s)", version, name)
+                    finally:
+                        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            finally:
+                conn.autocommit = False
+
+    def load_bans(self):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT user_id, ban_until FROM bans")
+                    return [(r['user_id'], r['ban_until']) for r in cur.fetchall()]
+
+    def upsert_ban(self, user_id, ban_until):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                    INSERT INTO bans (user_id, ban_until) VALUES (%s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET ban_until = EXCLUDED.ban_until
+                    """, (int(user_id), ban_until))
+
+    def delete_ban(self, user_id):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM bans WHERE user_id = %s", (int(user_id),))
+
+    def delete_expired_bans(self, user_ids, now_ts):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM bans WHERE user_id = ANY(%s) AND (ban_until IS NULL OR ban_until <= %s)",
+                        (list(user_ids), now_ts)
+                    )
+
+    def _insert_many(self, sql, rows):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, sql, rows, page_size=len(rows))
+
+    def insert_users(self, rows):
+        self._insert_many("INSERT INTO users (user_id, first_seen) VALUES %s ON CONFLICT DO NOTHING", rows)
+
+    def insert_joined_users(self, rows):
+        self._insert_many("INSERT INTO joined_users (user_id, joined_at) VALUES %s ON CONFLICT DO NOTHING", rows)
+
+    def has_joined(self, user_id):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1 FROM joined_users WHERE user_id = %s", (int(user_id),))
+                    return cur.fetchone() is not None
+
+    def stats(self, now_ts):
+        params = {
+            'now_ts': now_ts,
+            'last_24h': now_ts - timedelta(hours=24),
+            'last_7d': now_ts - timedelta(days=7),
+        }
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(STATS_SQL, params)
+                    row = cur.fetchone()
+        return {key: int(value) for key, value in row.items()}
 
-init_db()
+    def export_batches(self, kind, batch_size):
+        # مؤشر باسم (server-side) يجلب الصفوف على دفعات بدل fetchall للجدول كله
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor) as cur:
+                    cur.itersize = batch_size
+                    cur.execute(EXPORT_QUERIES[kind])
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+
+    def get_file_id(self, media_key, action, quality):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT file_id FROM media_files WHERE media_key = %s AND action = %s AND quality = %s",
+                        (media_key, action, quality)
+                    )
+                    row = cur.fetchone()
+                    return row['file_id'] if row else None
+
+    def put_file_id(self, media_key, action, quality, file_id, file_size):
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                    INSERT INTO media_files (media_key, action, quality, file_id, file_size) VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (media_key, action, quality) DO UPDATE
+                    SET file_id = EXCLUDED.file_id, file_size = EXCLUDED.file_size, created_at = now()
+                    """, (media_key, action, quality, file_id, file_size))
+
+    def delete_file_id(self, media_key, action, quality, file_id):
+        # نحذف المعرف المرفوض فقط، لا معرفاً أحدث حفظه عامل آخر في هذه الأثناء
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM media_files WHERE media_key = %s AND action = %s AND quality = %s AND file_id = %s",
+                        (media_key, action, quality, file_id)
+                    )
+
+    def metrics(self):
+        return self.pool.stats()
+
+# تحويل التواريخ صراحة بدل المحولات الافتراضية المهجورة في sqlite3
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+class SQLiteStorage(Storage):
+    # اتصال واحد محمي بقفل؛ مع ":memory:" يكفي لتشغيل البوت وقياس المسارات الساخنة محلياً
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def _execute(self, sql, params=(), many=False):
+        with self.lock:
+            self.queries += 1
+            with self.conn:
+                if many:
+                    return self.conn.executemany(sql, params).fetchall()
+                return self.conn.execute(sql, params).fetchall()
+
+    def init(self):
+        with self.lock:
+            self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS joined_users (
+            user_id INTEGER PRIMARY KEY,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS bans (
+            user_id INTEGER PRIMARY KEY,
+            ban_until TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS media_files (
+            media_key TEXT NOT NULL,
+            action TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (media_key, action, quality)
+            );
+            """)
+            for version, name, target in SCHEMA_INDEXES:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+    def load_bans(self):
+        return self._execute("SELECT user_id, ban_until FROM bans")
+
+    def upsert_ban(self, user_id, ban_until):
+        self._execute("""
+        INSERT INTO bans (user_id, ban_until) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET ban_until = excluded.ban_until
+        """, (int(user_id), ban_until))
+
+    def delete_ban(self, user_id):
+        self._execute("DELETE FROM bans WHERE user_id = ?", (int(user_id),))
+
+    def delete_expired_bans(self, user_ids, now_ts):
+        self._execute(
+            "DELETE FROM bans WHERE user_id = ? AND (ban_until IS NULL OR ban_until <= ?)",
+            [(int(user_id), now_ts) for user_id in user_ids],
+            many=True
+        )
+
+    def insert_users(self, rows):
+        self._execute("INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, ?)", rows, many=True)
+
+    def insert_joined_users(self, rows):
+        self._execute("INSERT OR IGNORE INTO joined_users (user_id, joined_at) VALUES (?, ?)", rows, many=True)
+
+    def has_joined(self, user_id):
+        return bool(self._execute("SELECT 1 FROM joined_users WHERE user_id = ?", (int(user_id),)))
+
+    def stats(self, now_ts):
+        row = self._execute("""
+        SELECT
+            COUNT(*),
+            COUNT(*) FILTER (WHERE first_seen >= ?),
+            COUNT(*) FILTER (WHERE first_seen >= ?),
+            (SELECT COUNT(*) FROM joined_users),
+            (SELECT COUNT(*) FROM bans WHERE ban_until > ?)
+        FROM users
+        """, (now_ts - timedelta(hours=24), now_ts - timedelta(days=7), now_ts))[0]
+        keys = ("total_users", "new_24h", "new_7d", "joined_total", "banned_now")
+        return dict(zip(keys, (int(value) for value in row)))
+
+    def export_batches(self, kind, batch_size):
+        with self.lock:
+            cur = self.conn.execute(EXPORT_QUERIES[kind])
+        while True:
+            with self.lock:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+    def get_file_id(self, media_key, action, quality):
+        rows = self._execute(
+            "SELECT file_id FROM media_files WHERE media_key = ? AND action = ? AND quality = ?",
+            (media_key, action, quality)
+        )
+        return rows[0][0] if rows else None
+
+    def put_file_id(self, media_key, action, quality, file_id, file_size):
+        self._execute("""
+        INSERT INTO media_files (media_key, action, quality, file_id, file_size) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (media_key, action, quality) DO UPDATE
+        SET file_id = excluded.file_id, file_size = excluded.file_size, created_at = CURRENT_TIMESTAMP
+        """, (media_key, action, quality, file_id, file_size))
+
+    def delete_file_id(self, media_key, action, quality, file_id):
+        self._execute(
+            "DELETE FROM media_files WHERE media_key = ? AND action = ? AND quality = ? AND file_id = ?",
+            (media_key, action, quality, file_id)
+        )
+
+    def metrics(self):
+        return {"path": SQLITE_PATH, "queries": self.queries}
+
+def create_storage():
+    if STORAGE_BACKEND == "postgres":
+        return PostgresStorage(DATABASE_URL)
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    raise RuntimeError(f"STORAGE_BACKEND غير معروف: {STORAGE_BACKEND} (المتاح: postgres, sqlite)")
+
+# ===== مصدر عمليات الوسائط =====
+class MediaZygote:
+    # عملية تُنشأ بـ fork مرة واحدة هنا، قبل أن يبدأ أي خيط أو اتصال بقاعدة البيانات، ثم تنسخ
+    # منها MediaProcessPool كل عملياته (بما فيها البدائل أثناء التشغيل). fork مباشرة من البوت
+    # متعدد الخيوط قد يورّث العملية قفلاً محجوزاً فتعلق حتى DOWNLOAD_TIMEOUT، و spawn يعيد
+    # تنفيذ bot.py كاملاً في كل عملية.
+    def __init__(self):
+        ctx = multiprocessing.get_context("fork")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=media_worker.zygote_main, args=(child_conn,), name="media-zygote", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+
+    def spawn(self):
+        # (pid، اتصال) لعملية عمل جديدة
+        with self.lock:
+            self.conn.send("spawn")
+            fd = recv_handle(self.conn)
+            pid = self.conn.recv()
+        return pid, Connection(fd)
+
+media_zygote = MediaZygote()
+
+storage = create_storage()
+storage.init()
 
 # ===== إعداد البوت و Flask =====
-bot = telebot.TeleBot(BOT_TOKEN)
+# threaded=False لأن التوزيع على العمال يتم عبر UpdateDispatcher بالأسفل
+if TELEGRAM_API_URL:
+    # البوت يجب أن يُسجَّل خروجه من الخادم العام (logOut) مرة واحدة قبل استخدام خادم آخر
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 app = Flask(__name__)
 
-# ===== هياكل الذاكرة المؤقتة =====
-user_links = {}
-user_platform = {}
-user_video_info = {}
-user_state = {}
+# ===== مصادر المقاييس (تظهر في /metrics) =====
+METRICS_SOURCES = []
+
+def register_metrics(title, fn):
+    METRICS_SOURCES.append((title, fn))
+
+register_metrics(f"التخزين ({storage.name})", storage.metrics)
+
+# ===== كاش بصلاحية زمنية وحد أقصى للعناصر (LRU) =====
+class TTLCache:
+    def __init__(self, max_entries, default_ttl):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": f"{(self.hits / total * 100) if total else 0:.1f}%",
+            }
+
+# ===== جلسات المستخدمين =====
+class UserSession:
+    # نحفظ فقط ما يقرؤه البوت فعلاً، وليس قاموس yt-dlp الكامل
+    __slots__ = ("state", "platform", "url", "media_key", "title", "duration", "action", "batch_urls", "touched")
+
+    def __init__(self):
+        self.state = None
+        self.platform = None
+        self.url = None
+        self.media_key = None
+        self.title = None
+        self.duration = None
+        self.action = None
+        self.batch_urls = None
+        self.touched = time.monotonic()
+
+    def set_link(self, url):
+        self.url = url
+        self.media_key = None
+        self.title = None
+        self.duration = None
+        self.action = None
+        self.batch_urls = None
+
+    def set_batch(self, urls):
+        self.set_link(None)
+        self.batch_urls = urls
+
+    def approx_size(self):
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            size += sys.getsizeof(getattr(self, name))
+        return size
+
+class SessionStore:
+    # جلسة واحدة لكل مستخدم، مع حد أقصى (LRU) وحذف الجلسات الخاملة
+    def __init__(self, max_sessions, idle_ttl):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def _evict(self, now):
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if len(self.sessions) <= self.max_sessions and now - oldest.touched < self.idle_ttl:
+                break
+            self.sessions.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or now - session.touched >= self.idle_ttl:
+                session = UserSession()
+                self.sessions[key] = session
+            session.touched = now
+            self.sessions.move_to_end(key)
+            self._evict(now)
+            return session
+
+    def peek(self, key):
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or time.monotonic() - session.touched >= self.idle_ttl:
+                return None
+            return session
+
+    def stats(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            approx = sum(session.approx_size() for session in self.sessions.values())
+            return {
+                "sessions": len(self.sessions),
+                "evicted": self.evicted,
+                "approx_kb": approx // 1024,
+            }
+
+sessions = SessionStore(SESSION_MAX, SESSION_IDLE_TTL)
+register_metrics("الجلسات", sessions.stats)
 PLATFORMS = ["يوتيوب", "انستغرام", "تيك توك"]
 
+# ===== فهرس الحظر في الذاكرة =====
+class BanIndex:
+    # نسخة من جدول bans في الذاكرة. انتهاء الحظر يُتابع عبر min-heap
+    # ويحذفه منظّف دوري على دفعات، فلا يلمس is_banned قاعدة البيانات.
+    def __init__(self):
+        self.bans = {}
+        self.heap = []
+        self.lock = threading.Lock()
+        self.swept = 0
+
+    def load(self):
+        rows = storage.load_bans()
+        with self.lock:
+            self.bans.clear()
+            self.heap = []
+            for user_id, ban_until in rows:
+                # ban_until الفارغ يعامل كحظر منتهٍ فيحذفه المنظّف
+                ban_until = ban_until or datetime.min
+                self.bans[int(user_id)] = ban_until
+                self.heap.append((ban_until, int(user_id)))
+            heapq.heapify(self.heap)
+
+    def remaining(self, user_id):
+        ban_until = self.bans.get(int(user_id))
+        if ban_until is None:
+            return 0
+        left = (ban_until - datetime.utcnow()).total_seconds()
+        return int(left) if left > 0 else 0
+
+    def add(self, user_id, ban_until):
+        with self.lock:
+            self.bans[int(user_id)] = ban_until
+            heapq.heappush(self.heap, (ban_until, int(user_id)))
+
+    def remove(self, user_id):
+        with self.lock:
+            self.bans.pop(int(user_id), None)
+            # إعادة بناء الـ heap إذا تراكمت فيه عناصر ملغاة
+            if len(self.heap) > 2 * len(self.bans) + 1024:
+                self.heap = [(until, uid) for uid, until in self.bans.items()]
+                heapq.heapify(self.heap)
+
+    def pop_expired(self, now_ts):
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now_ts:
+                ban_until, user_id = heapq.heappop(self.heap)
+                # قد يكون المستخدم أعيد حظره أو أُلغي حظره بعد إضافة هذا العنصر
+                if self.bans.get(user_id) == ban_until:
+                    del self.bans[user_id]
+                    expired.append(user_id)
+        return expired
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.bans), "heap": len(self.heap), "swept": self.swept}
+
+ban_index = BanIndex()
+register_metrics("الحظر", ban_index.stats)
+
+def sweep_expired_bans():
+    now_ts = datetime.utcnow()
+    expired = ban_index.pop_expired(now_ts)
+    if not expired:
+        return
+    storage.delete_expired_bans(expired, now_ts)
+    with ban_index.lock:
+        ban_index.swept += len(expired)
+
+def ban_sweeper_loop():
+    while True:
+        time.sleep(BAN_SWEEP_INTERVAL)
+        try:
+            sweep_expired_bans()
+        except Exception:
+            logging.exception("ban sweep failed")
+
+ban_index.load()
+threading.Thread(target=ban_sweeper_loop, name="ban-sweeper", daemon=True).start()
+
 # ===== دوال قاعدة البيانات =====
 def is_banned(user_id):
     if int(user_id) == OWNER_ID:
         return 0
-    now_ts = datetime.utcnow()
-    conn = get_db_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT ban_until FROM bans WHERE user_id = %s", (int(user_id),))
-                row = cur.fetchone()
-                if not row:
-                    return 0
-                ban_until = row['ban_until']
-                if ban_until and now_ts < ban_until:
-                    return int((ban_until - now_ts).total_seconds())
-                else:
-                    cur.execute("DELETE FROM bans WHERE user_id = %s", (int(user_id),))
-                    return 0
-    finally:
-        put_db_conn(conn)
+    return ban_index.remaining(user_id)
 
 def ban_user(user_id, duration=BAN_DURATION):
     if int(user_id) == OWNER_ID:
         return
     ban_until_dt = datetime.utcnow() + timedelta(seconds=duration)
-    conn = get_db_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                INSERT INTO bans (user_id, ban_until) VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET ban_until = EXCLUDED.ban_until
-                """, (int(user_id), ban_until_dt))
-    finally:
-        put_db_conn(conn)
+    storage.upsert_ban(user_id, ban_until_dt)
+    ban_index.add(user_id, ban_until_dt)
+
+def unban_user(user_id):
+    storage.delete_ban(user_id)
+    ban_index.remove(user_id)
+
+# ===== الكتابة المؤجلة (Write-behind) =====
+class WriteBehindBuffer:
+    # يجمع المعرفات الجديدة ويكتبها دفعة واحدة (INSERT متعدد الصفوف) كل فترة
+    # أو عند امتلاء الدفعة. المعرفات المحفوظة سابقاً لا تُكتب مرة أخرى.
+    def __init__(self, table, writer, flush_interval, flush_size, seen_size):
+        self.table = table
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.seen_size = seen_size
+        self.pending = {}
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flushed = 0
+        self.batches = 0
+        self.skipped = 0
+
+    def add(self, user_id):
+        user_id = int(user_id)
+        with self.lock:
+            if user_id in self.pending or user_id in self.seen:
+                self.skipped += 1
+                return
+            self.pending[user_id] = datetime.utcnow()
+            if len(self.pending) >= self.flush_size:
+                self.wakeup.set()
+
+    def contains(self, user_id):
+        user_id = int(user_id)
+        with self.lock:
+            return user_id in self.pending or user_id in self.seen
+
+    def mark_seen(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.seen[int(user_id)] = True
+                self.seen.move_to_end(int(user_id))
+            while len(self.seen) > self.seen_size:
+                self.seen.popitem(last=False)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            rows = list(batch.items())
+            try:
+                self.writer(rows)
+            except Exception:
+                # نعيد الدفعة للانتظار حتى لا تضيع، مع الحفاظ على أي إضافات أحدث
+                with self.lock:
+                    batch.update(self.pending)
+                    self.pending = batch
+                raise
+            self.mark_seen(batch)
+            with self.lock:
+                self.flushed += len(rows)
+                self.batches += 1
+            return len(rows)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("flush of %s failed", self.table)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "known": len(self.seen),
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "skipped": self.skipped,
+            }
+
+users_buffer = WriteBehindBuffer("users", storage.insert_users, WRITE_FLUSH_INTERVAL, WRITE_FLUSH_SIZE, WRITE_SEEN_SIZE)
+joined_buffer = WriteBehindBuffer("joined_users", storage.insert_joined_users, WRITE_FLUSH_INTERVAL, WRITE_FLUSH_SIZE, WRITE_SEEN_SIZE)
+register_metrics("كتابة users", users_buffer.stats)
+register_metrics("كتابة joined_users", joined_buffer.stats)
+for buffer in (users_buffer, joined_buffer):
+    threading.Thread(target=buffer.run, name=f"flush-{buffer.table}", daemon=True).start()
+
+def flush_pending_writes():
+    for buffer in (users_buffer, joined_buffer):
+        try:
+            buffer.flush()
+        except Exception:
+            logging.exception("final flush of %s failed", buffer.table)
+
+atexit.register(flush_pending_writes)
 
 def save_user(user_id):
-    conn = get_db_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (int(user_id),))
-    finally:
-        put_db_conn(conn)
+    users_buffer.add(user_id)
 
 def save_joined_user(user_id):
-    conn = get_db_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("INSERT INTO joined_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (int(user_id),))
-    finally:
-        put_db_conn(conn)
+    joined_buffer.add(user_id)
 
 def has_joined_before(user_id):
-    conn = get_db_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1 FROM joined_users WHERE user_id = %s", (int(user_id),))
-                return cur.fetchone() is not None
-    finally:
-        put_db_conn(conn)
+    if joined_buffer.contains(user_id):
+        return True
+    found = storage.has_joined(user_id)
+    if found:
+        joined_buffer.mark_seen([user_id])
+    return found
+
+JOINED_STATUSES = ('member', 'creator', 'administrator')
+
+# جدول العضوية المحلي: يُحدَّث فوراً من تحديثات chat_member الخاصة بالقناة،
+# ولا نسأل الـ API إلا عن مستخدم لم نره من قبل.
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_TTL)
+membership_events_live = threading.Event()
+register_metrics("كاش العضوية", lambda: {**membership_cache.stats(), "events_live": membership_events_live.is_set()})
+
+def remember_membership(user_id, joined):
+    # بعد وصول أول تحديث chat_member نعرف أن الاشتراك بالأحداث يعمل، فتبقى الحالة صالحة
+    # حتى يصل حدث يغيّرها أو تمر MEMBERSHIP_EVENTS_TTL، فحدث مغادرة ضائع لا يُبقي المستخدم
+    # عضواً للأبد. قبل ذلك نعتمد على مدة الصلاحية القصيرة.
+    if membership_events_live.is_set():
+        ttl = MEMBERSHIP_EVENTS_TTL
+    else:
+        ttl = MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+    membership_cache.set(int(user_id), joined, ttl)
 
-def is_user_joined(user_id):
+def is_user_joined(user_id, force_refresh=False):
+    if int(user_id) == OWNER_ID:
+        return True
+    user_id = int(user_id)
+    if not force_refresh:
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            return cached
     try:
-        if int(user_id) == OWNER_ID:
-            return True
-        member = bot.get_chat_member(f"@{CHANNEL_USERNAME}", int(user_id))
-        status = getattr(member, "status", None)
-        return status in ('member', 'creator', 'administrator')
+        member = bot.get_chat_member(f"@{CHANNEL_USERNAME}", user_id)
     except Exception:
         return False
+    status = getattr(member, "status", None)
+    joined = status in JOINED_STATUSES
+    remember_membership(user_id, joined)
+    return joined
+
+@bot.chat_member_handler(func=lambda update: (update.chat.username or "").lower() == CHANNEL_USERNAME.lower())
+def channel_member_update(update):
+    user_id = update.new_chat_member.user.id
+    was_joined = update.old_chat_member.status in JOINED_STATUSES
+    joined = update.new_chat_member.status in JOINED_STATUSES
+    membership_events_live.set()
+    remember_membership(user_id, joined)
+    if joined:
+        save_joined_user(user_id)
+    elif was_joined and has_joined_before(user_id):
+        ban_user(user_id)
 
 # ===== رسائل واجهة الاشتراك =====
 def send_welcome_with_channel(chat_id):
@@ -228,108 +1178,173 @@ def check_access(message_or_call):
         return False
     return True
 
+# ===== تحديد المعدل (Token bucket) =====
+def parse_rate(spec):
+    capacity, period = spec.split("/")
+    capacity = float(capacity)
+    return capacity, capacity / float(period)
+
+class RateLimiter:
+    def __init__(self, limits, max_buckets):
+        self.limits = {action: parse_rate(spec) for action, spec in limits.items()}
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.allowed = {action: 0 for action in self.limits}
+        self.rejected = {action: 0 for action in self.limits}
+
+    def acquire(self, user_id, action, cost=1):
+        # ترجع 0 إذا سُمح بالطلب، وإلا عدد الثواني حتى يتوفر رصيد كافٍ
+        capacity, rate = self.limits[action]
+        key = (int(user_id), action)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+                self.allowed[action] += 1
+            else:
+                wait = (cost - tokens) / rate
+                self.rejected[action] += 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def capacity(self, action):
+        return int(self.limits[action][0])
+
+    def stats(self):
+        with self.lock:
+            data = {"buckets": len(self.buckets)}
+            for action in self.limits:
+                data[action] = f"{self.allowed[action]} مسموح / {self.rejected[action]} مرفوض"
+            return data
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_MAX_BUCKETS)
+register_metrics("حدود المعدل", rate_limiter.stats)
+
+def check_rate(message_or_call, action, cost=1):
+    user_id = message_or_call.from_user.id
+    if action in RATE_GLOBAL_ACTIONS:
+        user_id = 0 # دلو واحد مشترك
+    elif int(user_id) == OWNER_ID:
+        return True
+    wait = rate_limiter.acquire(user_id, action, cost)
+    if wait <= 0:
+        return True
+    text = f"⏳ طلبات كثيرة، حاول مرة أخرى بعد {int(wait) + 1} ثانية."
+    try:
+        if isinstance(message_or_call, telebot.types.CallbackQuery):
+            bot.answer_callback_query(message_or_call.id, text)
+        else:
+            bot.send_message(message_or_call.chat.id, text)
+    except Exception:
+        pass
+    return False
+
 # ===== أوامر المالك (ADMIN COMMANDS) =====
+# ===== تصدير CSV مضغوط (بث مباشر من قاعدة البيانات) =====
+EXPORTS = {
+    "users": {
+        "header": ["user_id", "first_seen"],
+        "caption": "قائمة معرفات المستخدمين (CSV)",
+        "empty": "لا يوجد مستخدمين بعد.",
+        "error": "حدث خطأ أثناء جلب المستخدمين.",
+    },
+    "banned": {
+        "header": ["user_id", "ban_until"],
+        "caption": "قائمة المحظورين (CSV)",
+        "empty": "لا يوجد محظورين.",
+        "error": "حدث خطأ أثناء جلب المحظورين.",
+    },
+    "joined": {
+        "header": ["user_id", "joined_at"],
+        "caption": "قائمة من نفّذوا الشرط (CSV)",
+        "empty": "لا يوجد من نفذ الشرط بعد.",
+        "error": "حدث خطأ أثناء جلب القائمة.",
+    },
+}
+
+class CsvGzipPart:
+    def __init__(self, header):
+        self.buffer = io.BytesIO()
+        self.gzip = gzip.GzipFile(fileobj=self.buffer, mode="wb")
+        self.text = io.TextIOWrapper(self.gzip, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(header)
+        self.rows = 0
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.rows += len(rows)
+        self.text.flush()
+
+    def size(self):
+        return self.buffer.tell()
+
+    def close(self):
+        # إغلاق GzipFile لا يغلق الـ BytesIO الممرر له
+        self.text.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+def send_export(message, kind):
+    spec = EXPORTS[kind]
+    chat_id = message.chat.id
+    part = None
+    parts_sent = 0
+
+    def send_part(part):
+        data = part.close()
+        number = parts_sent + 1
+        name = f"{kind}.csv.gz" if number == 1 else f"{kind}_part{number}.csv.gz"
+        caption = spec["caption"] if number == 1 else f"{spec['caption']} - جزء {number}"
+        bot.send_document(chat_id, data, caption=caption, visible_file_name=name)
+
+    try:
+        for rows in storage.export_batches(kind, EXPORT_BATCH_SIZE):
+            if part is None:
+                part = CsvGzipPart(spec["header"])
+            part.write(rows)
+            if part.size() >= EXPORT_PART_BYTES:
+                send_part(part)
+                parts_sent += 1
+                part = None
+        if part is not None:
+            send_part(part)
+            parts_sent += 1
+        if parts_sent == 0:
+            bot.send_message(chat_id, spec["empty"])
+    except Exception:
+        logging.exception("export %s failed", kind)
+        bot.send_message(chat_id, spec["error"])
+
 @bot.message_handler(commands=['get_users'])
 def get_users_handler(message):
     if int(message.from_user.id) != OWNER_ID:
         return
-    try:
-        conn = get_db_conn()
-        rows = []
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, first_seen FROM users ORDER BY first_seen DESC")
-                rows = cur.fetchall()
-        put_db_conn(conn)
-
-        if not rows:
-            bot.send_message(message.chat.id, "لا يوجد مستخدمين بعد.")
-            return
-
-        fd, path = tempfile.mkstemp(suffix=".csv")
-        try:
-            with os.fdopen(fd, "w", newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(["user_id", "first_seen"])
-                for r in rows:
-                    writer.writerow([r['user_id'], r['first_seen']])
-            with open(path, "rb") as f:
-                bot.send_document(message.chat.id, f, caption="قائمة معرفات المستخدمين (CSV)")
-        finally:
-            try:
-                os.remove(path)
-            except:
-                pass
-    except Exception as e:
-        bot.send_message(message.chat.id, "حدث خطأ أثناء جلب المستخدمين.")
+    if not check_rate(message, "export"):
+        return
+    send_export(message, "users")
 
 @bot.message_handler(commands=['get_banned'])
 def get_banned_handler(message):
     if int(message.from_user.id) != OWNER_ID:
         return
-    try:
-        conn = get_db_conn()
-        rows = []
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, ban_until FROM bans ORDER BY ban_until DESC")
-                rows = cur.fetchall()
-        put_db_conn(conn)
-
-        if not rows:
-            bot.send_message(message.chat.id, "لا يوجد محظورين.")
-            return
-
-        fd, path = tempfile.mkstemp(suffix=".csv")
-        try:
-            with os.fdopen(fd, "w", newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(["user_id", "ban_until"])
-                for r in rows:
-                    writer.writerow([r['user_id'], r['ban_until']])
-            with open(path, "rb") as f:
-                bot.send_document(message.chat.id, f, caption="قائمة المحظورين (CSV)")
-        finally:
-            try:
-                os.remove(path)
-            except:
-                pass
-    except Exception as e:
-        bot.send_message(message.chat.id, "حدث خطأ أثناء جلب المحظورين.")
+    if not check_rate(message, "export"):
+        return
+    send_export(message, "banned")
 
 @bot.message_handler(commands=['get_joined'])
 def get_joined_handler(message):
     if int(message.from_user.id) != OWNER_ID:
         return
-    try:
-        conn = get_db_conn()
-        rows = []
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, joined_at FROM joined_users ORDER BY joined_at DESC")
-                rows = cur.fetchall()
-        put_db_conn(conn)
-
-        if not rows:
-            bot.send_message(message.chat.id, "لا يوجد من نفذ الشرط بعد.")
-            return
-
-        fd, path = tempfile.mkstemp(suffix=".csv")
-        try:
-            with os.fdopen(fd, "w", newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(["user_id", "joined_at"])
-                for r in rows:
-                    writer.writerow([r['user_id'], r['joined_at']])
-            with open(path, "rb") as f:
-                bot.send_document(message.chat.id, f, caption="قائمة من نفّذوا الشرط (CSV)")
-        finally:
-            try:
-                os.remove(path)
-            except:
-                pass
-    except Exception as e:
-        bot.send_message(message.chat.id, "حدث خطأ أثناء جلب القائمة.")
+    if not check_rate(message, "export"):
+        return
+    send_export(message, "joined")
 
 @bot.message_handler(commands=['ban_user'])
 def ban_user_command(message):
@@ -356,49 +1371,35 @@ def unban_user_command(message):
             bot.reply_to(message, "استخدم الأمر بهذا الشكل:\n/unban_user user_id")
             return
         user_id = parts[1]
-        conn = get_db_conn()
-        try:
-            with conn:
-                with conn.cursor() as cur:
-                    cur.execute("DELETE FROM bans WHERE user_id = %s", (int(user_id),))
-            bot.reply_to(message, f"تم إلغاء الحظر عن المستخدم {user_id}.")
-        finally:
-            put_db_conn(conn)
+        unban_user(user_id)
+        bot.reply_to(message, f"تم إلغاء الحظر عن المستخدم {user_id}.")
     except Exception as e:
         bot.reply_to(message, "حدث خطأ أثناء إلغاء الحظر.")
 
+stats_cache = TTLCache(1, STATS_CACHE_TTL)
+
+def fetch_stats():
+    now_ts = datetime.utcnow()
+    stats = storage.stats(now_ts)
+    stats['now_ts'] = now_ts
+    return stats
+
 @bot.message_handler(commands=['stats'])
 def stats_handler(message):
     if int(message.from_user.id) != OWNER_ID:
         return
 
-    conn = get_db_conn()
     try:
-        now_ts = datetime.utcnow()
-        last_24h = now_ts - timedelta(hours=24)
-        last_7d = now_ts - timedelta(days=7)
-
-        with conn:
-            with conn.cursor() as cur:
-                # إجمالي المستخدمين
-                cur.execute("SELECT COUNT(*) AS c FROM users")
-                total_users = int(cur.fetchone()['c'])
-
-                # مستخدمين جدد آخر 24 ساعة
-                cur.execute("SELECT COUNT(*) AS c FROM users WHERE first_seen >= %s", (last_24h,))
-                new_24h = int(cur.fetchone()['c'])
-
-                # مستخدمين جدد آخر 7 أيام
-                cur.execute("SELECT COUNT(*) AS c FROM users WHERE first_seen >= %s", (last_7d,))
-                new_7d = int(cur.fetchone()['c'])
-
-                # إجمالي من نفذوا شرط القناة
-                cur.execute("SELECT COUNT(*) AS c FROM joined_users")
-                joined_total = int(cur.fetchone()['c'])
-
-                # المحظورين حالياً (ban_until أكبر من الآن)
-                cur.execute("SELECT COUNT(*) AS c FROM bans WHERE ban_until IS NOT NULL AND ban_until > %s", (now_ts,))
-                banned_now = int(cur.fetchone()['c'])
+        stats = stats_cache.get("stats")
+        if stats is None:
+            stats = fetch_stats()
+            stats_cache.set("stats", stats)
+        now_ts = stats['now_ts']
+        total_users = stats['total_users']
+        new_24h = stats['new_24h']
+        new_7d = stats['new_7d']
+        joined_total = stats['joined_total']
+        banned_now = stats['banned_now']
 
         text = (
             "📊 <b>إحصائيات البوت</b>\n\n"
@@ -413,8 +1414,6 @@ def stats_handler(message):
 
     except Exception:
         bot.send_message(message.chat.id, "حدث خطأ أثناء حساب الإحصائيات.")
-    finally:
-        put_db_conn(conn)
 
 
 @bot.message_handler(commands=['joinedcheck'])
@@ -434,7 +1433,7 @@ def joinedcheck_handler(message):
         return
 
     # تحقق من حالة العضوية في القناة الآن
-    joined_now = is_user_joined(target_id)
+    joined_now = is_user_joined(target_id, force_refresh=True)
 
     # هل سبق وسجّل عندنا أنه انضم/تحقق؟
     joined_before = has_joined_before(target_id)
@@ -457,6 +1456,22 @@ def joinedcheck_handler(message):
 
     bot.send_message(message.chat.id, text, parse_mode="HTML")
 
+@bot.message_handler(commands=['metrics'])
+def metrics_handler(message):
+    if int(message.from_user.id) != OWNER_ID:
+        return
+    lines = ["📈 <b>مقاييس الأداء</b>"]
+    for title, fn in METRICS_SOURCES:
+        try:
+            data = fn()
+        except Exception:
+            logging.exception("metrics source %s failed", title)
+            continue
+        lines.append(f"\n<b>{title}</b>")
+        for key, value in data.items():
+            lines.append(f"• {key}: <code>{value}</code>")
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
 # ===== واجهة البوت =====
 def show_main_menu(chat_id, msg_only=False):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -469,7 +1484,7 @@ def show_main_menu(chat_id, msg_only=False):
         "✨ اختر الخدمة التي تريد استخدامها:\n"
         "🎬 أداة تحميل الفيديوهات والصوتيات (mp3/mp4) من يوتيوب أو انستغرام أو تيك توك.\n"
         "📡 أداة اختراق شبكات WiFi fh_.", reply_markup=markup)
-    user_state[chat_id] = "main_menu"
+    sessions.get(chat_id).state = "main_menu"
 
 def send_platforms(chat_id):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
@@ -477,7 +1492,7 @@ def send_platforms(chat_id):
         markup.add(p)
     markup.add("🔙 رجوع")
     bot.send_message(chat_id, "يرجى اختيار منصة:", reply_markup=markup)
-    user_state[chat_id] = "platforms"
+    sessions.get(chat_id).state = "platforms"
 
 @bot.message_handler(commands=['start'])
 def start_handler(message):
@@ -500,7 +1515,7 @@ def check_join_callback(call):
     if ban_left > 0:
         send_ban_with_check(call.message.chat.id, ban_left)
         return
-    if is_user_joined(user_id):
+    if is_user_joined(user_id, force_refresh=True):
         save_joined_user(user_id)
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add("🎬 أداة تحميل mp3/mp4", "📡 أداة اختراق WiFi fh")
@@ -513,14 +1528,14 @@ def check_join_callback(call):
             )
         except Exception:
             bot.send_message(call.message.chat.id, "✅ تم التحقق من اشتراكك في القناة!\n\nاختر الخدمة التي تريد استخدامها:", reply_markup=markup)
-        user_state[call.message.chat.id] = "main_menu"
+        sessions.get(call.message.chat.id).state = "main_menu"
     else:
         if has_joined_before(user_id):
             ban_user(user_id)
             send_ban_with_check(call.message.chat.id, BAN_DURATION)
         else:
             send_warning_join(call.message.chat.id)
-        user_state[call.message.chat.id] = "warned"
+        sessions.get(call.message.chat.id).state = "warned"
 
 @bot.callback_query_handler(func=lambda call: call.data == "recheck")
 def recheck_callback(call):
@@ -533,7 +1548,7 @@ def recheck_callback(call):
     if ban_left > 0:
         send_ban_with_check(call.message.chat.id, ban_left)
         return
-    if is_user_joined(user_id):
+    if is_user_joined(user_id, force_refresh=True):
         save_joined_user(user_id)
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add("🎬 أداة تحميل mp3/mp4", "📡 أداة اختراق WiFi fh")
@@ -546,7 +1561,7 @@ def recheck_callback(call):
             )
         except Exception:
             bot.send_message(call.message.chat.id, "✅ تم التحقق من اشتراكك في القناة!\n\nاختر الخدمة التي تريد استخدامها:", reply_markup=markup)
-        user_state[call.message.chat.id] = "main_menu"
+        sessions.get(call.message.chat.id).state = "main_menu"
     else:
         ban_user(user_id)
         send_ban_with_check(call.message.chat.id, BAN_DURATION)
@@ -569,19 +1584,19 @@ def ask_for_link(message):
         return
     # ==================================
 
-    user_platform[message.from_user.id] = message.text
+    sessions.get(message.from_user.id).platform = message.text
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     markup.add("🔙 رجوع")
     bot.send_message(message.chat.id, f"📥 أرسل رابط الفيديو من {message.text}:", reply_markup=markup)
-    user_state[message.chat.id] = "waiting_link"
+    sessions.get(message.chat.id).state = "waiting_link"
 
 @bot.message_handler(func=lambda m: m.text == "🔙 رجوع")
 def back_handler(message):
     if not check_access(message):
         return
-    state = user_state.get(message.chat.id, "main_menu")
+    state = sessions.get(message.chat.id).state or "main_menu"
     if state == "waiting_link":
-        user_platform.pop(message.from_user.id, None)
+        sessions.get(message.from_user.id).platform = None
         send_platforms(message.chat.id)
     elif state == "platforms":
         show_main_menu(message.chat.id, msg_only=True)
@@ -592,103 +1607,1351 @@ def back_handler(message):
     else:
         show_main_menu(message.chat.id, msg_only=True)
 
+# ===== عمليات منفصلة لعمل yt-dlp و ffmpeg =====
+class MediaJobTimeout(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
+
+class MediaWorker:
+    __slots__ = ("pid", "conn", "jobs")
+
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.jobs = 0
+
+class MediaProcessPool:
+    # yt-dlp ثقيل على المعالج ويتنافس مع Flask و telebot على الـ GIL، والمستخرج المعلّق
+    # في خيط لا يمكن إيقافه. هنا تعمل كل مهمة في عملية منفصلة: انتهاء المهلة يقتل العملية
+    # فعلاً، وكل عملية تُستبدل بعد max_jobs مهمة للحد من تضخم الذاكرة.
+    # العمليات تُنسخ من media_zygote وليس من البوت نفسه (انظر MediaZygote).
+    def __init__(self, zygote, size, max_jobs):
+        self.zygote = zygote
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+        self.cancelled = 0
+        for _ in range(size):
+            self.idle.put(self._spawn())
+
+    def _spawn(self):
+        return MediaWorker(*self.zygote.spawn())
+
+    def _acquire(self, cancel):
+        while True:
+            try:
+                return self.idle.get(timeout=None if cancel is None else CANCEL_POLL_INTERVAL)
+            except queue.Empty:
+                if cancel.is_set():
+                    raise JobCancelled("cancelled while waiting for a media worker")
+
+    def run(self, fn, *args, timeout, on_progress=None, cancel=None, **kwargs):
+        # ينتظر عملية متاحة ثم ينفذ fn فيها؛ on_progress يُستدعى هنا في خيط المستدعي.
+        # ضبط cancel (threading.Event) يقتل العملية ويرفع JobCancelled خلال CANCEL_POLL_INTERVAL.
+        worker = self._acquire(cancel)
+        broken = True
+        with self.lock:
+            self.busy += 1
+        try:
+            worker.conn.send((fn, args, kwargs, on_progress is not None))
+            deadline = time.monotonic() + timeout
+            while True:
+                if cancel is not None and cancel.is_set():
+                    with self.lock:
+                        self.cancelled += 1
+                    raise JobCancelled(fn.__name__)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self.lock:
+                        self.timeouts += 1
+                    raise MediaJobTimeout(f"{fn.__name__} exceeded {timeout:.0f}s")
+                if not worker.conn.poll(remaining if cancel is None else min(remaining, CANCEL_POLL_INTERVAL)):
+                    continue
+                try:
+                    kind, value = worker.conn.recv()
+                except EOFError:
+                    with self.lock:
+                        self.crashes += 1
+                    raise RuntimeError(f"media worker died during {fn.__name__}")
+                if kind == "progress":
+                    try:
+                        on_progress(value)
+                    except Exception:
+                        logging.exception("progress callback for %s failed", fn.__name__)
+                    continue
+                broken = False
+                worker.jobs += 1
+                with self.lock:
+                    if kind == "ok":
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                if kind == "error":
+                    raise value
+                return value
+        finally:
+            with self.lock:
+                self.busy -= 1
+            self._release(worker, broken)
+
+    def _release(self, worker, broken):
+        if not broken and worker.jobs < self.max_jobs:
+            self.idle.put(worker)
+            return
+        if broken:
+            # مهلة منتهية أو إلغاء أو اتصال مقطوع: لا يمكن الوثوق بحالة العملية
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            worker.conn.send(None)
+            with self.lock:
+                self.recycled += 1
+            # العملية تخرج عند None؛ إن لم تغلق اتصالها خلال مهلة قصيرة نقتلها
+            try:
+                if not worker.conn.poll(5) or worker.conn.recv() is not None:
+                    os.kill(worker.pid, signal.SIGKILL)
+            except EOFError:
+                pass
+            except ProcessLookupError:
+                pass
+        worker.conn.close()
+        self.idle.put(self._spawn())
+
+    def stats(self):
+        with self.lock:
+            return {
+                "processes": self.size,
+                "busy": self.busy,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+                "crashes": self.crashes,
+                "recycled": self.recycled,
+                "cancelled": self.cancelled,
+            }
+
+media_pool = MediaProcessPool(media_zygote, MEDIA_PROCESSES, MEDIA_WORKER_MAX_JOBS)
+register_metrics("عمليات yt-dlp/ffmpeg", media_pool.stats)
+
+# ===== كاش بيانات الوسائط =====
+# مفتاح الكاش هو المعرف الثابت من yt-dlp (extractor + id) حتى تتشارك الروابط
+# المختلفة لنفس المقطع نتيجة واحدة، مع فهرس صغير من الرابط إلى المفتاح.
+METADATA_HEAVY_KEYS = ("thumbnails", "subtitles", "automatic_captions", "heatmap", "comments", "chapters", "description")
+
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_TTL)
+metadata_urls = TTLCache(METADATA_CACHE_SIZE * 8, METADATA_TTL)
+register_metrics("كاش البيانات الوصفية", metadata_cache.stats)
+
+def media_key(info):
+    return f"{info.get('extractor_key') or info.get('extractor')}:{info.get('id')}"
+
+def cached_metadata(url):
+    key = metadata_urls.get(url)
+    return metadata_cache.get(key) if key else None
+
+# استخراج واحد لكل رابط في نفس الوقت: مرحلة التحميل تنتظر الاستخراج الذي بدأه
+# handle_link في الخلفية بدل أن تبدأ استخراجاً ثانياً للرابط نفسه
+metadata_pending = {} # url -> Future
+metadata_pending_lock = threading.Lock()
+metadata_executor = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix="metadata")
+
+def wait_for_metadata(future, cancel):
+    if cancel is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_INTERVAL)
+        except FutureTimeout:
+            if cancel.is_set():
+                raise JobCancelled("cancelled while waiting for metadata")
+
+def extract_metadata(url, cancel=None):
+    info = cached_metadata(url)
+    if info is not None:
+        return info
+    with metadata_pending_lock:
+        future = metadata_pending.get(url)
+        leader = future is None
+        if leader:
+            future = metadata_pending[url] = Future()
+    if not leader:
+        try:
+            return wait_for_metadata(future, cancel)
+        except JobCancelled:
+            # أُلغيت مهمة صاحب الاستخراج وليس مهمتنا، فنبدأ استخراجنا
+            if cancel is not None and cancel.is_set():
+                raise
+            return extract_metadata(url, cancel)
+    try:
+        info = media_pool.run(media_worker.extract_info, url, METADATA_HEAVY_KEYS, timeout=EXTRACT_TIMEOUT, cancel=cancel)
+        key = media_key(info)
+        metadata_cache.set(key, info)
+        metadata_urls.set(url, key)
+        future.set_result(info)
+        return info
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with metadata_pending_lock:
+            metadata_pending.pop(url, None)
+
+# ===== كاش file_id =====
+# بعد أول رفع ناجح يعيد تيليجرام file_id يمكن إعادة إرساله فوراً بدون تحميل أو رفع،
+# فنحفظه بمفتاح (المقطع، نوع التحميل، الجودة) ونجربه قبل بدء أي تحميل.
+file_id_cache = TTLCache(FILE_ID_CACHE_SIZE, math.inf)
+file_id_counters = {"served": 0, "stored": 0, "invalidated": 0}
+file_id_counters_lock = threading.Lock()
+
+def count_file_id(name):
+    # العدادات تُحدَّث من خيوط الـ dispatcher والتحميل معاً
+    with file_id_counters_lock:
+        file_id_counters[name] += 1
+
+def file_id_metrics():
+    with file_id_counters_lock:
+        counters = dict(file_id_counters)
+    return {**file_id_cache.stats(), **counters}
+
+register_metrics("كاش file_id", file_id_metrics)
+
+def audio_codec_mapping():
+    # صيغة preferredcodec في FFmpegExtractAudio: "m4a>m4a/mp3>mp3/mp4>m4a/mp3" تعني أن m4a و mp3
+    # يبقيان كما هما، وصوت mp4 يُنقل إلى m4a (نسخ إذا كان AAC)، وكل ما عداها يُحوّل إلى AUDIO_CODEC
+    return "/".join([ext if ">" in ext else f"{ext}>{ext}" for ext in AUDIO_PASSTHROUGH] + [AUDIO_CODEC])
+
+def media_quality(action):
+    return VIDEO_FORMAT if action == "video" else f"{AUDIO_FORMAT}|{audio_codec_mapping()}-{AUDIO_QUALITY}"
+
+def lookup_file_id(key, action):
+    cache_key = (key, action, media_quality(action))
+    file_id = file_id_cache.get(cache_key)
+    if file_id is None:
+        try:
+            file_id = storage.get_file_id(*cache_key)
+        except Exception:
+            logging.exception("file_id lookup for %s failed", key)
+            return None
+        if file_id:
+            file_id_cache.set(cache_key, file_id)
+    return file_id
+
+def remember_file_id(key, action, sent):
+    media = sent.video if action == "video" else sent.audio
+    if media is None:
+        # تيليجرام حوّل الملف إلى مستند؛ معرفه لا يصلح لـ send_video/send_audio
+        return
+    cache_key = (key, action, media_quality(action))
+    try:
+        storage.put_file_id(*cache_key, media.file_id, media.file_size)
+    except Exception:
+        logging.exception("storing file_id for %s failed", key)
+        return
+    file_id_cache.set(cache_key, media.file_id)
+    count_file_id("stored")
+
+def forget_file_id(key, action, file_id):
+    cache_key = (key, action, media_quality(action))
+    file_id_cache.pop(cache_key)
+    count_file_id("invalidated")
+    try:
+        storage.delete_file_id(*cache_key, file_id)
+    except Exception:
+        logging.exception("deleting file_id for %s failed", key)
+
+def send_media(chat_id, action, media):
+    if action == "video":
+        return bot.send_video(chat_id, media, caption="✅ تم التحميل بنجاح! 🎬", timeout=UPLOAD_TIMEOUT)
+    return bot.send_audio(chat_id, media, caption="✅ تم التحميل بنجاح! 🎵", timeout=UPLOAD_TIMEOUT)
+
+@contextmanager
+def upload_inputs(paths):
+    # ما يُمرَّر لـ send_*: مسارات file:// للخادم المحلي، وإلا ملفات مفتوحة تُغلق بعد الإرسال
+    if TELEGRAM_API_LOCAL:
+        yield [f"file://{os.path.abspath(path)}" for path in paths]
+        return
+    files = [open(path, "rb") for path in paths]
+    try:
+        yield files
+    finally:
+        for f in files:
+            f.close()
+
+def send_audio_parts(chat_id, parts, title=None):
+    # parts ملفات مفتوحة أو مسارات file:// أو معرفات file_id بالترتيب؛ تُرسل كمجموعة وسائط واحدة
+    media = [
+        types.InputMediaAudio(part, title=f"{title} ({i}/{len(parts)})" if title else None,
+                              caption="✅ تم التحميل بنجاح! 🎵 (مقسّم إلى أجزاء)" if i == 1 else None)
+        for i, part in enumerate(parts, 1)
+    ]
+    return bot.send_media_group(chat_id, media, timeout=UPLOAD_TIMEOUT)
+
+def download_limit(action):
+    # أكبر ملف نقبل تحميله: الصوت المقسّم يُرسل حتى AUDIO_SPLIT_MAX_PARTS أجزاء كل منها ضمن الحد
+    if action == "audio" and AUDIO_SPLIT:
+        return UPLOAD_MAX_BYTES * AUDIO_SPLIT_MAX_PARTS
+    return UPLOAD_MAX_BYTES
+
+def source_limit(action):
+    # للصوت قد يكون المصدر فيديو أكبر بكثير من الناتج بعد التحويل، فحده أثناء التحميل أوسع
+    if action == "audio":
+        return int(download_limit(action) * AUDIO_SOURCE_RATIO)
+    return download_limit(action)
+
+def is_bad_file_id(description):
+    # "Bad Request: wrong file identifier/HTTP URL specified" أو "wrong remote file identifier specified"
+    description = (description or "").lower()
+    return "wrong file identifier" in description or "wrong remote file" in description
+
+def send_cached_media(chat_id, key, action):
+    # True إذا أُرسل الملف من الكاش؛ المعرف الذي يرفضه تيليجرام كمعرف غير صالح يُحذف ونكمل بالتحميل العادي
+    if not key:
+        return False
+    file_id = lookup_file_id(key, action)
+    if not file_id:
+        return False
+    try:
+        send_media(chat_id, action, file_id)
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code == 400 and is_bad_file_id(e.description):
+            logging.warning("telegram rejected cached file_id for %s: %s", key, e.description)
+            forget_file_id(key, action, file_id)
+        else:
+            # أخطاء 400 الأخرى (محادثة غير موجودة، بوت محظور...) لا تعني أن المعرف تالف
+            logging.warning("sending cached file_id for %s failed: %s", key, e.description)
+        return False
+    except Exception:
+        logging.exception("sending cached file_id for %s failed", key)
+        return False
+    count_file_id("served")
+    return True
+
+def send_next_step_menu(chat_id):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add("منصة أخرى", "نفس المنصة", "🔙 رجوع")
+    bot.send_message(chat_id, "💡 ماذا تريد أن تفعل الآن؟", reply_markup=markup)
+    sessions.get(chat_id).state = "waiting_link"
+
+def link_caption(info):
+    if info is None:
+        return "🎬 اختر نوع التحميل:\n\n🎬 تحميل الفيديو (mp4)\n🎵 تحميل الصوت (mp3)"
+    title = html.escape(info.get('title') or 'بدون عنوان')
+    duration = int(info.get('duration', 0) or 0)
+    mins = duration // 60
+    secs = duration % 60
+    return f"🎬 <b>{title}</b>\n⏱️ المدة: {mins}:{secs:02d}\n\n🎬 تحميل الفيديو (mp4) أو 🎵 تحميل الصوت (mp3):"
+
+def remember_link_metadata(session, url, info):
+    # المستخدم ربما أرسل رابطاً آخر أثناء الاستخراج؛ لا نكتب بيانات رابط قديم فوق الجديد
+    if session.url != url:
+        return
+    session.media_key = media_key(info)
+    session.title = info.get('title', 'بدون عنوان')
+    session.duration = int(info.get('duration', 0) or 0)
+
+def fill_link_caption(chat_id, message_id, session, url, markup):
+    try:
+        info = extract_metadata(url)
+    except Exception:
+        logging.info("metadata extraction for %s failed", url, exc_info=True)
+        info = None
+    if info is not None:
+        remember_link_metadata(session, url, info)
+    try:
+        bot.edit_message_text(link_caption(info), chat_id, message_id, parse_mode="HTML", reply_markup=markup)
+    except Exception:
+        logging.exception("editing link caption in chat %s failed", chat_id)
+
+def extract_urls(text):
+    # الروابط بترتيب ظهورها بدون تكرار
+    urls = []
+    for url in re.findall(r"https?://\S+", text):
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+def batch_limit(user_id):
+    # كل رابط في الدفعة يُحسب كطلب metadata و download مستقل، فلا تتجاوز الدفعة سعة الدلوين
+    # (دفعة أكبر من السعة لن تجد رصيداً كافياً أبداً)
+    if int(user_id) == OWNER_ID:
+        return BATCH_MAX_LINKS
+    return min(BATCH_MAX_LINKS, rate_limiter.capacity("metadata"), rate_limiter.capacity("download"))
+
+def offer_batch(message, urls):
+    note = ""
+    limit = batch_limit(message.from_user.id)
+    if len(urls) > limit:
+        note = f"\n⚠️ سيتم تحميل أول {limit} روابط فقط."
+        urls = urls[:limit]
+    if not check_rate(message, "metadata", cost=len(urls)):
+        return
+    sessions.get(message.from_user.id).set_batch(urls)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("🎬 تحميل الفيديو للكل", callback_data="batch:video"),
+        types.InlineKeyboardButton("🎵 تحميل الصوت للكل", callback_data="batch:audio")
+    )
+    bot.send_message(message.chat.id, f"📦 تم العثور على {len(urls)} روابط.{note}\n\nاختر نوع التحميل لها جميعاً:", reply_markup=markup)
+    bot.send_message(message.chat.id, "⬅️ للرجوع اضغط على زر 🔙 رجوع في الأسفل.")
+
+@bot.message_handler(content_types=['document'], func=lambda m: (m.document.file_name or "").lower().endswith(".txt"))
+def handle_links_file(message):
+    if not check_access(message):
+        return
+    if sessions.get(message.chat.id).state != "waiting_link":
+        bot.send_message(message.chat.id, "❗ يرجى اختيار المنصة أولاً من القائمة بالأسفل.")
+        send_platforms(message.chat.id)
+        return
+    if (message.document.file_size or 0) > BATCH_FILE_MAX_BYTES:
+        bot.send_message(message.chat.id, f"❌ ملف الروابط كبير جداً (الحد {format_bytes(BATCH_FILE_MAX_BYTES)}).")
+        return
+    try:
+        data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+    except Exception:
+        logging.exception("downloading links file from chat %s failed", message.chat.id)
+        bot.send_message(message.chat.id, "❌ تعذر قراءة الملف، حاول مرة أخرى.")
+        return
+    urls = extract_urls(data.decode("utf-8", errors="replace"))
+    if not urls:
+        bot.send_message(message.chat.id, "❌ لم يتم العثور على روابط في الملف.")
+        return
+    offer_batch(message, urls)
+
 @bot.message_handler(func=lambda m: m.text and m.text.startswith("http"))
 def handle_link(message):
     if not check_access(message):
         return
-    state = user_state.get(message.chat.id)
+    state = sessions.get(message.chat.id).state
     if state != "waiting_link":
         bot.send_message(message.chat.id, "❗ يرجى اختيار المنصة أولاً من القائمة بالأسفل.")
         send_platforms(message.chat.id)
         return
-    
-    platform = user_platform.get(message.from_user.id)
-    url = message.text.strip()
-    user_links[message.from_user.id] = url
-    caption = "🎬 اختر نوع التحميل:\n\n🎬 تحميل الفيديو (mp4)\n🎵 تحميل الصوت (mp3)"
+    urls = extract_urls(message.text)
+    if len(urls) > 1:
+        offer_batch(message, urls)
+        return
+    if not check_rate(message, "metadata"):
+        return
+
+    session = sessions.get(message.from_user.id)
+    url = urls[0] if urls else message.text.strip()
+    session.set_link(url)
     markup = types.InlineKeyboardMarkup()
     markup.add(
         types.InlineKeyboardButton("🎬 تحميل الفيديو", callback_data="video"),
         types.InlineKeyboardButton("🎵 تحميل الصوت (mp3)", callback_data="audio")
     )
-    try:
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            user_video_info[message.from_user.id] = info
-            title = info.get('title', 'بدون عنوان')
-            duration = info.get('duration', 0) or 0
-            mins = duration // 60
-            secs = duration % 60
-            caption = f"🎬 <b>{title}</b>\n⏱️ المدة: {mins}:{secs:02d}\n\n🎬 تحميل الفيديو (mp4) أو 🎵 تحميل الصوت (mp3):"
-    except Exception as e:
-        caption = caption
-    bot.send_message(message.chat.id, caption, parse_mode="HTML", reply_markup=markup)
+    info = cached_metadata(url)
+    if info is not None:
+        remember_link_metadata(session, url, info)
+        bot.send_message(message.chat.id, link_caption(info), parse_mode="HTML", reply_markup=markup)
+    else:
+        # نرد فوراً بالأزرار، والعنوان والمدة يُضافان بتعديل الرسالة عند انتهاء الاستخراج
+        msg = bot.send_message(message.chat.id, "🎬 اختر نوع التحميل:\n\n🔎 جاري جلب معلومات المقطع...", reply_markup=markup)
+        metadata_executor.submit(fill_link_caption, message.chat.id, msg.message_id, session, url, markup)
     bot.send_message(message.chat.id, "⬅️ للرجوع اضغط على زر 🔙 رجوع في الأسفل.", reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True).add("🔙 رجوع"))
-    user_state[message.chat.id] = "waiting_link"
+    sessions.get(message.chat.id).state = "waiting_link"
+
+# ===== تعديل رسائل الحالة (مع تجميع وتحديد للمعدل) =====
+class StatusEditor:
+    # تعديل واحد على الأكثر كل interval لكل محادثة؛ التحديثات المتلاحقة لنفس الرسالة
+    # تُدمج فيبقى آخر نص فقط، والنص المعلّق لا يُهمل أبداً فتصل الحالة النهائية دائماً.
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {} # (chat_id, message_id) -> (text, reply_markup)
+        self.last = {} # chat_id -> وقت آخر تعديل
+        self.cond = threading.Condition()
+        self.edits = 0
+        self.coalesced = 0
+        self.failed = 0
+        threading.Thread(target=self._loop, name="status-editor", daemon=True).start()
+
+    def edit(self, chat_id, message_id, text, reply_markup=None):
+        # بدون reply_markup يحذف تيليجرام الأزرار، فرسائل التقدم تمرر زر الإلغاء في كل تعديل
+        with self.cond:
+            if (chat_id, message_id) in self.pending:
+                self.coalesced += 1
+            self.pending[(chat_id, message_id)] = (text, reply_markup)
+            self.cond.notify()
+
+    def discard(self, chat_id, message_id):
+        # قبل حذف الرسالة أو استبدالها، حتى لا يصلها تعديل قديم بعد ذلك
+        with self.cond:
+            self.pending.pop((chat_id, message_id), None)
+
+    def _next_due(self):
+        target, due_at = None, None
+        for chat_id, message_id in self.pending:
+            at = self.last.get(chat_id, 0) + self.interval
+            if due_at is None or at < due_at:
+                target, due_at = (chat_id, message_id), at
+        return target, due_at
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    target, due_at = self._next_due()
+                    if target is not None and due_at <= now:
+                        break
+                    self.cond.wait(None if target is None else due_at - now)
+                text, reply_markup = self.pending.pop(target)
+                self.last[target[0]] = now
+                if len(self.last) > len(self.pending) + 1000:
+                    self.last = {chat_id: at for chat_id, at in self.last.items() if at + self.interval > now}
+            try:
+                bot.edit_message_text(text, *target, reply_markup=reply_markup)
+                self.edits += 1
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # نؤجل هذه المحادثة حسب retry_after ونعيد النص ما لم يصل أحدث منه
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', self.interval)
+                    with self.cond:
+                        self.last[target[0]] = time.monotonic() + retry_after - self.interval
+                        self.pending.setdefault(target, (text, reply_markup))
+                elif "message is not modified" not in str(e.description):
+                    self.failed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception("status edit for chat %s failed", target[0])
+
+    def stats(self):
+        with self.cond:
+            return {"pending": len(self.pending), "edits": self.edits, "coalesced": self.coalesced, "failed": self.failed}
+
+status_editor = StatusEditor(STATUS_EDIT_INTERVAL)
+register_metrics("تعديل رسائل الحالة", status_editor.stats)
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def cancel_markup(job_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("❌ إلغاء التحميل", callback_data=f"cancel:{job_id}"))
+    return markup
 
-def process_download_threaded(call, url, action):
-    msg = bot.send_message(call.message.chat.id, "⏳ جاري التحميل، انتظر قليلاً...")
-    tmpdir = tempfile.mkdtemp()
+def job_status(job, text):
+    # طلبات الدفعة تكتب في رسالة الدفعة المجمّعة بدل رسالة حالة خاصة بكل رابط
+    if job.batch is not None:
+        job.batch.report(job, text)
+    else:
+        status_editor.edit(job.chat_id, job.message_id, text, cancel_markup(job.id))
+
+def close_job_status(job, error_text=None):
+    # نهاية الطلب: تُحذف رسالة الحالة عند النجاح أو تُعدّل لنص الخطأ، ثم قائمة الخطوة التالية
+    if job.batch is not None:
+        job.batch.finish(job, error_text)
+        return
     try:
-        ydl_opts = {
-            'outtmpl': os.path.join(tmpdir, '%(title)s.%(ext)s'),
-            'format': 'best',
-            'noplaylist': True,
-            'quiet': True,
-        }
-        if action == "audio":
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            if action == "video":
-                filename = ydl.prepare_filename(info)
-            else:
-                filename = ydl.prepare_filename(info).rsplit('.', 1)[0] + ".mp3"
-        
+        if error_text:
+            status_editor.edit(job.chat_id, job.message_id, error_text)
+        else:
+            status_editor.discard(job.chat_id, job.message_id)
+            bot.delete_message(job.chat_id, job.message_id)
+    except Exception:
+        # مثلاً حذف المستخدم رسالة الحالة بنفسه؛ القائمة تُرسل رغم ذلك
+        logging.exception("closing status message %s in chat %s failed", job.message_id, job.chat_id)
+    send_next_step_menu(job.chat_id)
+
+class DownloadProgress:
+    # progress hook لـ yt-dlp يحوّل تقدم التحميل إلى نص في رسالة الحالة عبر job_status
+    def __init__(self, job):
+        self.job = job
+        self.percent = None
+
+    def __call__(self, d):
+        if d.get('status') == 'finished':
+            job_status(self.job, "⚙️ اكتمل التحميل، جاري التجهيز والإرسال...")
+            return
+        if d.get('status') != 'downloading':
+            return
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        downloaded = d.get('downloaded_bytes') or 0
+        if total:
+            percent = min(100, int(downloaded * 100 / total))
+        elif d.get('fragment_count'):
+            percent = int((d.get('fragment_index') or 0) * 100 / d['fragment_count'])
+        else:
+            percent = None
+        # yt-dlp يستدعي الـ hook مع كل جزء صغير؛ لا داعي لتحديث لم يتغير فيه الرقم
+        if percent is not None and percent == self.percent:
+            return
+        self.percent = percent
+        lines = [f"⏳ جاري التحميل... {percent}%" if percent is not None else f"⏳ جاري التحميل... {format_bytes(downloaded)}"]
+        if d.get('speed'):
+            lines.append(f"🚀 السرعة: {format_bytes(d['speed'])}/s")
+        if d.get('eta') is not None:
+            lines.append(f"⏱️ المتبقي: {format_duration(d['eta'])}")
+        job_status(self.job, "\n".join(lines))
+
+# ===== تقدير الحجم قبل التحميل =====
+def is_audio_only(fmt):
+    return fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none'
+
+def estimated_size(info, action):
+    # أقل حجم ممكن قبل التحميل، أو None إذا لم نستطع التقدير
+    if action == "audio":
+        # أصغر صيغة صوت فقط (إن عُرفت كل أحجامها) أو حجم التحويل المتوقع، أيهما أقل
+        estimates = []
+        sizes = [format_size(fmt) for fmt in info.get('formats') or [] if is_audio_only(fmt)]
+        if sizes and None not in sizes:
+            estimates.append(min(sizes))
+        # المصدر الذي سيُختار: صيغ الصوت فقط، وإلا الصيغ الكاملة (AUDIO_FORMAT يرجع إلى best)
+        formats = info.get('formats') or [info]
+        candidates = [fmt for fmt in formats if is_audio_only(fmt)] or formats
+        sources = {entry.split(">", 1)[0] for entry in AUDIO_PASSTHROUGH}
+        if any(fmt.get('ext') in sources for fmt in candidates):
+            # قد يُنسخ الصوت بدون إعادة ترميز فيبقى بمعدل المصدر، لا بمعدل AUDIO_QUALITY
+            rates = [fmt.get('abr') for fmt in candidates if fmt.get('ext') in sources]
+            if info.get('duration') and rates and None not in rates:
+                estimates.append(int(info['duration'] * min(rates) * 1000 / 8))
+        # جودة VBR (0-10) لا تعطي معدلاً ثابتاً نقدّر منه
+        elif AUDIO_QUALITY.isdigit() and int(AUDIO_QUALITY) > 10 and info.get('duration'):
+            estimates.append(int(info['duration'] * int(AUDIO_QUALITY) * 1000 / 8))
+        return min(estimates) if estimates else None
+    sizes = [format_size(fmt) for fmt in info.get('formats') or [info]]
+    if not sizes or None in sizes:
+        return None
+    return min(sizes)
+
+# ===== دمج التحميلات المتزامنة لنفس المقطع (single-flight) =====
+# أول طلب لـ (المقطع، نوع التحميل) يحمّل ويرفع، وكل طلب يصل أثناء ذلك ينضم كمنتظر
+# ويحرر عامله فوراً؛ القائد يرسل للمنتظرين نفس file_id أو نفس رسالة الخطأ.
+class InFlightDownloads:
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def lead_or_wait(self, key, waiter):
+        # True إذا أصبح المستدعي القائد، وإلا أضيفت مهمة waiter إلى المنتظرين
+        with self.lock:
+            if key in self.flights:
+                self.flights[key].append(waiter)
+                self.coalesced += 1
+                return False
+            self.flights[key] = []
+            return True
+
+    def finish(self, key):
+        with self.lock:
+            return self.flights.pop(key, [])
+
+    def leave(self, job_id, user_id):
+        # إلغاء منتظر: يُزال وحده ويبقى التحميل لبقية المنتظرين
+        with self.lock:
+            for waiters in self.flights.values():
+                for job in waiters:
+                    if job.id == job_id and (job.user_id == int(user_id) or int(user_id) == OWNER_ID):
+                        waiters.remove(job)
+                        return job
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": len(self.flights),
+                "waiting": sum(len(waiters) for waiters in self.flights.values()),
+                "coalesced": self.coalesced,
+            }
+
+in_flight_downloads = InFlightDownloads()
+register_metrics("التحميلات المدمجة", in_flight_downloads.stats)
+
+def deliver_to_waiters(waiters, action, sent, error_text):
+    media = None
+    if isinstance(sent, list):
+        # صوت مقسّم أُرسل كمجموعة وسائط
+        media = [message.audio.file_id for message in sent]
+    elif sent is not None:
+        media = sent.video if action == "video" else sent.audio
+    for job in waiters:
+        chat_id = job.chat_id
+        job_error = error_text
+        if job.cancelled.is_set():
+            # ضغط الإلغاء في اللحظة التي كان ينضم فيها إلى المنتظرين
+            job_error = "🚫 تم إلغاء التحميل."
+        else:
+            try:
+                if isinstance(media, list):
+                    send_audio_parts(chat_id, media)
+                elif media is not None:
+                    send_media(chat_id, action, media.file_id)
+                elif sent is not None:
+                    # تيليجرام حوّل الملف إلى مستند، فنعيد إرساله كما هو
+                    bot.send_document(chat_id, sent.document.file_id, caption=sent.caption)
+            except Exception:
+                logging.exception("delivering coalesced download to chat %s failed", chat_id)
+                job_error = "❌ حدث خطأ أثناء التحميل، يرجى إعادة المحاولة."
+        # فشل منتظر واحد لا يمنع بقية المنتظرين من استلام الملف
+        try:
+            close_job_status(job, job_error)
+        except Exception:
+            logging.exception("closing coalesced download status in chat %s failed", chat_id)
+
+def requeue_waiters(waiters):
+    # إلغاء القائد يخص صاحبه فقط: المنتظرون يعودون إلى الطابور بترتيبهم الأصلي،
+    # فيصبح أولهم القائد الجديد وينضم الباقون إليه من جديد
+    for job in waiters:
+        job.position = 0
+        if job.cancelled.is_set() or not download_scheduler.submit(job):
+            try:
+                close_job_status(job, "❌ حدث خطأ أثناء التحميل، يرجى إعادة المحاولة.")
+            except Exception:
+                logging.exception("closing requeued download status in chat %s failed", job.chat_id)
+
+# ===== كاش الوسائط على القرص (LRU بحد أقصى للحجم) =====
+class MediaCache:
+    # كل عنصر مجلد باسم هاش (المقطع، نوع التحميل، الجودة) فيه ملف واحد باسمه الأصلي
+    # (تيليجرام يعرض اسم الملف). يُجهّز العنصر في مجلد .tmp ثم يُنشر بإعادة تسمية ذرية،
+    # فلا يظهر في الكاش ملف ناقص حتى لو توقف البوت في منتصف الكتابة.
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.jobs_dir = os.path.join(root, "jobs")
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # name -> (path, size)، الأقدم استخداماً أولاً
+        self.total = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    ENTRY_NAME = re.compile(r"[0-9a-f]{40}")
+    STAGING_NAME = re.compile(r"[0-9a-f]{40}\.[0-9a-f]{32}\.tmp")
+
+    def _load(self):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        # مجلدات مهام انقطعت بتوقف البوت
+        for name in os.listdir(self.jobs_dir):
+            shutil.rmtree(os.path.join(self.jobs_dir, name), ignore_errors=True)
+        if self.max_bytes <= 0:
+            return
+        # MEDIA_CACHE_DIR قد يكون مجلداً مشتركاً: لا نلمس إلا الأسماء التي ينشئها الكاش نفسه،
+        # فنحذف عناصر لم تُنشر أو فسدت ونترك كل ما عداها كما هو
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if self.STAGING_NAME.fullmatch(name):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not self.ENTRY_NAME.fullmatch(name) or not os.path.isdir(path):
+                continue
+            files = os.listdir(path)
+            if len(files) != 1 or not os.path.isfile(os.path.join(path, files[0])):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            file_path = os.path.join(path, files[0])
+            stat = os.stat(file_path)
+            found.append((stat.st_mtime, name, file_path, stat.st_size))
+        # وقت التعديل يُحدَّث عند كل استخدام، فيعيد ترتيب LRU بعد إعادة التشغيل
+        for _, name, file_path, size in sorted(found):
+            self.entries[name] = (file_path, size)
+            self.total += size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def entry_name(key, action):
+        return hashlib.sha1(f"{key}|{action}|{media_quality(action)}".encode()).hexdigest()
+
+    def new_job_dir(self):
+        return tempfile.mkdtemp(dir=self.jobs_dir)
+
+    def link(self, key, action, dest_dir):
+        # نضع رابطاً صلباً في مجلد المهمة بدل المسار نفسه، فلا يتأثر الإرسال بإخلاء العنصر
+        name = self.entry_name(key, action)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            path = entry[0]
+            target = os.path.join(dest_dir, os.path.basename(path))
+            try:
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copyfile(path, target)
+                os.utime(path)
+            except FileNotFoundError:
+                # حُذف من خارج البوت
+                self.entries.pop(name)
+                self.total -= entry[1]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return target
+
+    def store(self, key, action, path):
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return
+        name = self.entry_name(key, action)
+        staging = os.path.join(self.root, f"{name}.{uuid.uuid4().hex}.tmp")
+        os.mkdir(staging)
+        os.replace(path, os.path.join(staging, os.path.basename(path)))
+        final = os.path.join(self.root, name)
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.total -= old[1]
+            shutil.rmtree(final, ignore_errors=True)
+            os.rename(staging, final)
+            self.entries[name] = (os.path.join(final, os.path.basename(path)), size)
+            self.total += size
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and self.entries:
+            name, (path, size) = self.entries.popitem(last=False)
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            self.total -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size": format_bytes(self.total),
+                "budget": format_bytes(self.max_bytes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": f"{(self.hits / total * 100) if total else 0:.1f}%",
+                "evictions": self.evictions,
+            }
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES)
+register_metrics("كاش الوسائط على القرص", media_cache.stats)
+
+def extract_audio(path, cancel=None):
+    return media_pool.run(media_worker.extract_audio, path, audio_codec_mapping(), AUDIO_QUALITY, timeout=DOWNLOAD_TIMEOUT, cancel=cancel)
+
+def download_media(info, job, tmpdir):
+    action = job.action
+    if action == "video":
+        format_spec, postprocessors = VIDEO_FORMAT, []
+    else:
+        # لا يُعاد الترميز إذا كان المصدر بصيغة يقبلها تيليجرام كصوت (m4a/mp3 أو AAC داخل mp4)
+        format_spec, postprocessors = AUDIO_FORMAT, [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': audio_codec_mapping(),
+            'preferredquality': AUDIO_QUALITY,
+        }]
+    return media_pool.run(
+        media_worker.download, info, action, tmpdir, format_spec, postprocessors, download_limit(action),
+        source_limit=source_limit(action),
+        timeout=DOWNLOAD_TIMEOUT, cancel=job.cancelled,
+        on_progress=DownloadProgress(job)
+    )
+
+# نتيجة طلب انضم إلى تحميل قائم: لم يكتمل ولم يفشل بعد، فالقائد هو من يسلّمه لاحقاً
+JOB_HANDED_OFF = object()
+
+def process_download_job(job):
+    chat_id = job.chat_id
+    url = job.url
+    action = job.action
+    sent = None
+    error_text = None
+    flight_key = None
+    cancelled = False
+    if job.position > 0:
+        job_status(job, "⏳ جاري التحميل، انتظر قليلاً...")
+    tmpdir = media_cache.new_job_dir()
+    try:
+        # نبدأ من البيانات المستخرجة مسبقاً (أو نستخرجها مرة واحدة) بدل إعادة تحليل الصفحة
+        info = extract_metadata(url, cancel=job.cancelled)
+        key = media_key(info)
+        if job.batch is not None:
+            job.batch.set_title(job, info.get('title'))
+        # الرابط قد يكون لمقطع سبق رفعه من رابط آخر، فنعيد فحص الكاش بالمفتاح الثابت
+        if send_cached_media(chat_id, key, action):
+            close_job_status(job)
+            return True
+        estimate = estimated_size(info, action)
+        if estimate and estimate > download_limit(action):
+            raise DownloadTooLarge(url)
+        if not in_flight_downloads.lead_or_wait((key, action), job):
+            # القائد سيرسل الملف (أو الخطأ) وقائمة الخطوة التالية لهذه المحادثة
+            job_status(job, "⏳ هذا المقطع قيد التحميل لطلب آخر، سيصلك فور انتهائه...")
+            return JOB_HANDED_OFF
+        flight_key = (key, action)
+        filename = media_cache.link(key, action, tmpdir)
+        from_cache = filename is not None
+        if filename is None and action == "audio":
+            # المستخدم حمّل الفيديو قبل قليل؟ نستخرج الصوت منه بدل تحميل جديد
+            video = media_cache.link(key, "video", tmpdir)
+            if video is not None:
+                job_status(job, "🎵 جاري استخراج الصوت...")
+                filename = extract_audio(video, cancel=job.cancelled)
+        if filename is None:
+            filename = download_media(info, job, tmpdir)
+        # الإلغاء أثناء آخر لحظات المعالجة: لا نرفع ملفاً لم يعد صاحبه يريده
+        if job.cancelled.is_set():
+            raise JobCancelled(url)
+
         if not os.path.exists(filename):
-            bot.edit_message_text("❌ فشل التحميل أو الملف غير موجود.", call.message.chat.id, msg.message_id)
+            error_text = "❌ فشل التحميل أو الملف غير موجود."
+        elif os.path.getsize(filename) > download_limit(action):
+            error_text = "❌ الملف كبير جداً ولا يمكن إرساله عبر التليجرام."
         else:
-            max_bytes = 45 * 1024 * 1024
-            size = os.path.getsize(filename)
-            if size > max_bytes:
-                bot.edit_message_text("❌ الملف كبير جداً ولا يمكن إرساله عبر التليجرام.", call.message.chat.id, msg.message_id)
+            if os.path.getsize(filename) > UPLOAD_MAX_BYTES:
+                # وضع AUDIO_SPLIT: لا نحفظ file_id لأن المجموعة لا تُعاد بمعرف واحد، والملف الكامل يبقى في كاش القرص
+                job_status(job, "✂️ الملف أكبر من حد تيليجرام، جاري تقسيمه إلى أجزاء...")
+                parts = media_pool.run(media_worker.split_audio, filename, info.get('duration'), UPLOAD_MAX_BYTES, AUDIO_SPLIT_MAX_PARTS,
+                                       timeout=DOWNLOAD_TIMEOUT, cancel=job.cancelled)
+                if job.cancelled.is_set():
+                    raise JobCancelled(url)
+                with upload_inputs(parts) as files:
+                    sent = send_audio_parts(chat_id, files, info.get('title') or 'audio')
             else:
-                with open(filename, "rb") as f:
-                    if action == "video":
-                        bot.send_video(call.message.chat.id, f, caption="✅ تم التحميل بنجاح! 🎬")
-                    else:
-                        bot.send_audio(call.message.chat.id, f, caption="✅ تم التحميل بنجاح! 🎵")
-                bot.delete_message(call.message.chat.id, msg.message_id)
+                with upload_inputs([filename]) as (media,):
+                    sent = send_media(chat_id, action, media)
+                remember_file_id(key, action, sent)
+            try:
+                if not from_cache:
+                    media_cache.store(key, action, filename)
+            except OSError:
+                logging.exception("caching %s on disk failed", key)
+    except DownloadTooLarge:
+        logging.info("download of %s skipped or aborted over %s bytes", url, download_limit(action))
+        error_text = "❌ الملف كبير جداً ولا يمكن إرساله عبر التليجرام."
+    except JobCancelled:
+        logging.info("download of %s cancelled by user %s", url, job.user_id)
+        cancelled = True
+        error_text = "🚫 تم إلغاء التحميل."
+    except MediaJobTimeout:
+        logging.warning("download of %s timed out after %ss", url, DOWNLOAD_TIMEOUT)
+        error_text = "❌ استغرق التحميل وقتاً أطول من المسموح، حاول مرة أخرى لاحقاً."
     except Exception as e:
-        bot.edit_message_text("❌ حدث خطأ أثناء التحميل، يرجى إعادة المحاولة.", call.message.chat.id, msg.message_id)
+        logging.exception("download of %s failed", url)
+        error_text = "❌ حدث خطأ أثناء التحميل، يرجى إعادة المحاولة."
     finally:
-        try:
-            for root, dirs, files in os.walk(tmpdir):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-            os.rmdir(tmpdir)
-        except:
-            pass
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    markup.add("منصة أخرى", "نفس المنصة", "🔙 رجوع")
-    bot.send_message(call.message.chat.id, "💡 ماذا تريد أن تفعل الآن؟", reply_markup=markup)
-    user_state[call.message.chat.id] = "waiting_link"
+        # يشمل مجلد أجزاء الصوت المقسّم داخل مجلد المهمة
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    try:
+        close_job_status(job, error_text)
+    except Exception:
+        # الملف وصل (أو الخطأ سُجّل)، فلا يُحسب الطلب فاشلاً بسبب رسالة الحالة أو القائمة
+        logging.exception("closing download status in chat %s failed", chat_id)
+    finally:
+        # المنتظرون يُسلَّمون دائماً، وإلا بقي المفتاح محجوزاً وانتظر كل طلب لاحق للأبد
+        if flight_key is not None:
+            waiters = in_flight_downloads.finish(flight_key)
+            if cancelled:
+                requeue_waiters(waiters)
+            else:
+                deliver_to_waiters(waiters, action, sent, error_text)
+    return sent is not None
+
+# ===== جدولة التحميلات =====
+class DownloadJob:
+    __slots__ = ("id", "user_id", "chat_id", "url", "action", "priority", "message_id", "position",
+                 "enqueued_at", "started_at", "cancelled", "batch")
+
+    def __init__(self, job_id, user_id, chat_id, url, action, priority):
+        self.id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.url = url
+        self.action = action
+        self.priority = priority
+        self.message_id = None
+        self.position = 0
+        self.enqueued_at = None
+        self.started_at = None
+        self.cancelled = threading.Event()
+        self.batch = None
+
+class DownloadScheduler:
+    # طابور أولويات بعدد عمال ثابت: المالك في مسار أولوية، وكل مستخدم
+    # له حد للتحميلات المتزامنة وحد لإجمالي طلباته المعلقة.
+    def __init__(self, runner, workers, user_running, user_pending):
+        self.runner = runner
+        self.workers = workers
+        self.user_running = user_running
+        self.user_pending = user_pending
+        self.queue = []
+        self.jobs = {} # job_id -> job، للمنتظرة والجارية فقط
+        self.running = {}
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.handed_off = 0 # طلبات سلّمها قائد تحميل مدمج
+        self.wait_times = deque(maxlen=100)
+        self.run_times = deque(maxlen=100)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"download-worker-{i}", daemon=True).start()
+
+    def new_job(self, user_id, chat_id, url, action):
+        priority = 0 if int(user_id) == OWNER_ID else 1
+        with self.cond:
+            self.seq += 1
+            return DownloadJob(self.seq, int(user_id), chat_id, url, action, priority)
+
+    def can_accept(self, user_id):
+        with self.cond:
+            return int(user_id) == OWNER_ID or self.pending.get(int(user_id), 0) < self.user_pending
+
+    def submit(self, job):
+        with self.cond:
+            # الدفعة تُقبل كاملة عند إنشائها (can_accept و BATCH_MAX_LINKS)، فلا يُرفض جزء منها هنا
+            if job.priority > 0 and job.batch is None and self.pending.get(job.user_id, 0) >= self.user_pending:
+                self.rejected += 1
+                return False
+            job.enqueued_at = time.monotonic()
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.queue.sort(key=lambda j: (j.priority, j.id))
+            self.pending[job.user_id] = self.pending.get(job.user_id, 0) + 1
+            self.cond.notify()
+            return True
+
+    def cancel(self, job_id, user_id):
+        # "queued" إذا أزيل من الطابور، "running" إذا أُبلغ العامل، أو None إذا لم يوجد
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None or (job.user_id != int(user_id) and int(user_id) != OWNER_ID):
+                return None
+            job.cancelled.set()
+            if job not in self.queue:
+                return "running"
+            self.queue.remove(job)
+            del self.jobs[job.id]
+            self._release_pending(job.user_id)
+            self.cancelled += 1
+            self.cond.notify_all()
+            return "queued"
+
+    def _release_pending(self, user_id):
+        self.pending[user_id] -= 1
+        if not self.pending[user_id]:
+            del self.pending[user_id]
+
+    def position(self, job):
+        # 0 يعني أن الطلب سيبدأ فوراً، وإلا فهو ترتيبه بين المنتظرين
+        with self.cond:
+            if job in self.queue:
+                ahead = self.queue.index(job)
+            else:
+                ahead = sum(1 for queued in self.queue if queued.priority <= job.priority)
+            free = self.workers - sum(self.running.values())
+            return max(0, ahead + 1 - free)
+
+    def estimate_wait(self, position):
+        with self.cond:
+            avg_run = (sum(self.run_times) / len(self.run_times)) if self.run_times else 30
+        return math.ceil(avg_run * math.ceil(position / self.workers))
+
+    def _take(self):
+        for job in self.queue:
+            if self.running.get(job.user_id, 0) < self.user_running or job.priority == 0:
+                self.queue.remove(job)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._take()
+                while job is None:
+                    self.cond.wait()
+                    job = self._take()
+                self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+                job.started_at = time.monotonic()
+                self.wait_times.append(job.started_at - job.enqueued_at)
+                waiting = self.queue[:DOWNLOAD_POSITION_UPDATES]
+            self._refresh_positions(waiting)
+            ok = False
+            try:
+                ok = self.runner(job)
+            except Exception:
+                ok = False
+                logging.exception("download job %s failed", job.id)
+            finally:
+                with self.cond:
+                    if ok is JOB_HANDED_OFF:
+                        # زمن الانضمام لا يمثل مدة تحميل، فلا يدخل في تقدير الانتظار
+                        self.handed_off += 1
+                    else:
+                        self.run_times.append(time.monotonic() - job.started_at)
+                        if ok:
+                            self.completed += 1
+                        elif job.cancelled.is_set():
+                            self.cancelled += 1
+                        else:
+                            self.failed += 1
+                    self.jobs.pop(job.id, None)
+                    self.running[job.user_id] -= 1
+                    if not self.running[job.user_id]:
+                        del self.running[job.user_id]
+                    self._release_pending(job.user_id)
+                    self.cond.notify_all()
+
+    def _refresh_positions(self, waiting):
+        for job in waiting:
+            position = self.position(job)
+            if job.message_id is None or position == job.position:
+                continue
+            job.position = position
+            status_editor.edit(job.chat_id, job.message_id, queue_status_text(position, self.estimate_wait(position)), cancel_markup(job.id))
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": len(self.queue),
+                "running": sum(self.running.values()),
+                "workers": self.workers,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "handed_off": self.handed_off,
+                "avg_wait_s": f"{(sum(self.wait_times) / len(self.wait_times)) if self.wait_times else 0:.1f}",
+                "max_wait_s": f"{max(self.wait_times) if self.wait_times else 0:.1f}",
+                "avg_run_s": f"{(sum(self.run_times) / len(self.run_times)) if self.run_times else 0:.1f}",
+            }
+
+def queue_status_text(position, wait):
+    if position <= 0:
+        return "⏳ جاري التحميل، انتظر قليلاً..."
+    return (
+        "🕒 تمت إضافة طلبك إلى قائمة الانتظار.\n"
+        f"ترتيبك: {position}\n"
+        f"الوقت المتوقع للبدء: ~{wait} ثانية"
+    )
+
+download_scheduler = DownloadScheduler(process_download_job, DOWNLOAD_WORKERS, DOWNLOAD_USER_RUNNING, DOWNLOAD_USER_PENDING)
+register_metrics("التحميلات", download_scheduler.stats)
+
+# ===== دفعات الروابط =====
+class DownloadBatch:
+    # روابط رسالة واحدة (أو ملف نصي) تمر بالمجدول كطلبات عادية، فتُرسل نتائجها فور اكتمال كل
+    # منها، لكن برسالة حالة واحدة مجمّعة وقائمة الخطوة التالية مرة واحدة بعد آخر رابط
+    def __init__(self, jobs, chat_id, message_id):
+        self.id = jobs[0].id
+        self.jobs = jobs
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.titles = {} # job_id -> عنوان المقطع بعد استخراج بياناته
+        self.lines = {} # job_id -> آخر سطر حالة للطلبات الجارية
+        self.finished = set()
+        self.done = 0
+        self.cancelled = 0
+        self.failed = [] # (الرابط، نص الخطأ)
+        self.lock = threading.Lock()
+        for job in jobs:
+            job.batch = self
+
+    def set_title(self, job, title):
+        with self.lock:
+            self.titles[job.id] = title
+
+    def report(self, job, text):
+        with self.lock:
+            if job.id in self.finished:
+                return
+            self.lines[job.id] = text.split("\n", 1)[0]
+        status_editor.edit(self.chat_id, self.message_id, self.render(), batch_cancel_markup(self.id))
+
+    def finish(self, job, error_text):
+        with self.lock:
+            # الإلغاء قد يصل من زر الدفعة ومن الطلب نفسه؛ نحسب كل طلب مرة واحدة
+            if job.id in self.finished:
+                return
+            self.finished.add(job.id)
+            self.lines.pop(job.id, None)
+            if not error_text:
+                self.done += 1
+            elif job.cancelled.is_set():
+                self.cancelled += 1
+            else:
+                self.failed.append((job.url, error_text))
+            complete = len(self.finished) == len(self.jobs)
+        if complete:
+            download_batches.finish(self)
+            status_editor.edit(self.chat_id, self.message_id, self.render())
+            send_next_step_menu(self.chat_id)
+        else:
+            status_editor.edit(self.chat_id, self.message_id, self.render(), batch_cancel_markup(self.id))
+
+    def render(self):
+        with self.lock:
+            total = len(self.jobs)
+            complete = len(self.finished) == total
+            lines = [
+                f"📦 {'انتهى تحميل' if complete else 'جاري تحميل'} {total} روابط",
+                f"✅ تم: {self.done} | ❌ فشل: {len(self.failed)} | ⏳ متبقي: {total - len(self.finished)}",
+            ]
+            if self.cancelled:
+                lines.append(f"🚫 ملغى: {self.cancelled}")
+            if self.lines:
+                lines.append("")
+                for job_id, line in self.lines.items():
+                    title = (self.titles.get(job_id) or "...")[:60]
+                    lines.append(f"▶️ {title}: {line}")
+            if complete and self.failed:
+                lines.append("")
+                lines.extend(f"❌ {url}\n{error}" for url, error in self.failed[:10])
+        return "\n".join(lines)
+
+class DownloadBatches:
+    def __init__(self):
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.links = 0
+
+    def add(self, batch):
+        with self.lock:
+            self.batches[batch.id] = batch
+            self.started += 1
+            self.links += len(batch.jobs)
+
+    def get(self, batch_id):
+        with self.lock:
+            return self.batches.get(batch_id)
+
+    def finish(self, batch):
+        with self.lock:
+            if self.batches.pop(batch.id, None) is not None:
+                self.completed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": len(self.batches),
+                "started": self.started,
+                "completed": self.completed,
+                "links": self.links,
+            }
+
+download_batches = DownloadBatches()
+register_metrics("دفعات الروابط", download_batches.stats)
+
+def batch_cancel_markup(batch_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("❌ إلغاء الدفعة", callback_data=f"batch_cancel:{batch_id}"))
+    return markup
+
+@bot.callback_query_handler(func=lambda call: call.data in ("batch:video", "batch:audio"))
+def process_batch_download(call):
+    if not check_access(call):
+        return
+    session = sessions.peek(call.from_user.id)
+    urls = session.batch_urls if session else None
+    action = call.data.split(":", 1)[1]
+    if not urls:
+        bot.answer_callback_query(call.id, "❌ لم يتم العثور على روابط، أرسلها من جديد.")
+        return
+    if not download_scheduler.can_accept(call.from_user.id):
+        bot.answer_callback_query(call.id, "⚠️ لديك طلبات تحميل قيد التنفيذ، انتظر حتى تنتهي.")
+        return
+    if not check_rate(call, "download", cost=len(urls)):
+        return
+    session.batch_urls = None
+    bot.answer_callback_query(call.id, "⏳ جاري التحميل، ستصلك الملفات تباعاً.")
+    # استخراج بيانات كل الروابط بالتوازي الآن، فتجدها طلبات التحميل جاهزة (أو قيد الاستخراج)
+    # بينما يعمل المجدول على أولها
+    for url in urls:
+        if cached_metadata(url) is None:
+            metadata_executor.submit(extract_metadata, url)
+    jobs = [download_scheduler.new_job(call.from_user.id, call.message.chat.id, url, action) for url in urls]
+    msg = bot.send_message(call.message.chat.id, f"📦 تمت إضافة {len(jobs)} روابط إلى قائمة التحميل...", reply_markup=batch_cancel_markup(jobs[0].id))
+    batch = DownloadBatch(jobs, call.message.chat.id, msg.message_id)
+    download_batches.add(batch)
+    for job in jobs:
+        download_scheduler.submit(job)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("batch_cancel:"))
+def cancel_batch(call):
+    batch = download_batches.get(int(call.data.split(":", 1)[1]))
+    if batch is None:
+        bot.answer_callback_query(call.id, "ℹ️ لا يوجد تحميل قيد التنفيذ لإلغائه.")
+        return
+    if batch.jobs[0].user_id != int(call.from_user.id) and int(call.from_user.id) != OWNER_ID:
+        bot.answer_callback_query(call.id, "ℹ️ لا يوجد تحميل قيد التنفيذ لإلغائه.")
+        return
+    bot.answer_callback_query(call.id, "🚫 جاري إلغاء الدفعة...")
+    for job in batch.jobs:
+        state = download_scheduler.cancel(job.id, call.from_user.id)
+        if state is None and in_flight_downloads.leave(job.id, call.from_user.id) is not None:
+            job.cancelled.set()
+            state = "waiting"
+        # الطلبات الجارية تُبلغ الدفعة عن إلغائها بنفسها بعد إيقاف عملياتها
+        if state in ("queued", "waiting"):
+            close_job_status(job, "🚫 تم إلغاء التحميل.")
 
 @bot.callback_query_handler(func=lambda call: call.data in ("video", "audio"))
 def process_download(call):
     if not check_access(call):
         return
-    url = user_links.get(call.from_user.id)
+    session = sessions.peek(call.from_user.id)
+    url = session.url if session else None
     action = call.data
     if not url:
         bot.answer_callback_query(call.id, "❌ لم يتم العثور على رابط، أرسل الرابط من جديد.")
         return
+    if not download_scheduler.can_accept(call.from_user.id):
+        bot.answer_callback_query(call.id, "⚠️ لديك طلبات تحميل قيد التنفيذ، انتظر حتى تنتهي.")
+        return
+    if not check_rate(call, "download"):
+        return
+    session.action = action
     bot.answer_callback_query(call.id, "⏳ جاري التحميل، سيتم إرسال الملف عند الانتهاء.")
-    threading.Thread(target=process_download_threaded, args=(call, url, action)).start()
+    # مقطع سبق رفعه يُرسل فوراً بمعرفه دون المرور بطابور التحميل
+    if send_cached_media(call.message.chat.id, session.media_key, action):
+        send_next_step_menu(call.message.chat.id)
+        return
+    job = download_scheduler.new_job(call.from_user.id, call.message.chat.id, url, action)
+    job.position = download_scheduler.position(job)
+    msg = bot.send_message(job.chat_id, queue_status_text(job.position, download_scheduler.estimate_wait(job.position)), reply_markup=cancel_markup(job.id))
+    job.message_id = msg.message_id
+    if not download_scheduler.submit(job):
+        bot.edit_message_text("⚠️ لديك طلبات تحميل قيد التنفيذ، انتظر حتى تنتهي.", job.chat_id, job.message_id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("cancel:"))
+def cancel_download(call):
+    job_id = int(call.data.split(":", 1)[1])
+    state = download_scheduler.cancel(job_id, call.from_user.id)
+    if state is None and in_flight_downloads.leave(job_id, call.from_user.id) is not None:
+        state = "waiting"
+    if state is None:
+        bot.answer_callback_query(call.id, "ℹ️ لا يوجد تحميل قيد التنفيذ لإلغائه.")
+        return
+    bot.answer_callback_query(call.id, "🚫 جاري الإلغاء...")
+    # المهمة الجارية تُبلغ عن إلغائها بنفسها بعد إيقاف عمليتها وحذف ملفاتها المؤقتة
+    if state != "running":
+        status_editor.edit(call.message.chat.id, call.message.message_id, "🚫 تم إلغاء التحميل.")
+        send_next_step_menu(call.message.chat.id)
 
 # ===== WiFi tool =====
 def show_wifi_methods(chat_id):
@@ -699,7 +2962,7 @@ def show_wifi_methods(chat_id):
         "✍️ كتابة اسم الراوتر يدويًا (fh_...)\n"
         "🖼️ أو أرسل صورة لقائمة الشبكات.",
         reply_markup=markup)
-    user_state[chat_id] = "wifi_methods"
+    sessions.get(chat_id).state = "wifi_methods"
 
 @bot.message_handler(func=lambda m: m.text == "📡 أداة اختراق WiFi fh")
 def wifi_request(message):
@@ -715,7 +2978,7 @@ def manual_ssid(message):
     markup.add("🔙 رجوع")
     sent = bot.send_message(message.chat.id, "🔍 أرسل اسم شبكة WiFi (يجب أن تبدأ بـ fh_):", reply_markup=markup)
     bot.register_next_step_handler(sent, generate_password_with_back)
-    user_state[message.chat.id] = "wifi_name_or_image"
+    sessions.get(message.chat.id).state = "wifi_name_or_image"
 
 def generate_password_with_back(message):
     if not check_access(message):
@@ -733,7 +2996,7 @@ def ask_for_wifi_image(message):
     markup.add("🔙 رجوع")
     sent = bot.send_message(message.chat.id, "📸 أرسل صورة لقائمة شبكات WiFi الظاهرة في إعدادات هاتفك الراوترات المدعومة التي تبدا ب fh فقط.", reply_markup=markup)
     bot.register_next_step_handler(sent, process_wifi_image_with_back)
-    user_state[message.chat.id] = "wifi_name_or_image"
+    sessions.get(message.chat.id).state = "wifi_name_or_image"
 
 def process_wifi_image_with_back(message):
     if not check_access(message):
@@ -773,6 +3036,8 @@ def smart_correct_ssid(ssid):
 def process_wifi_image(message):
     if not check_access(message):
         return
+    if not check_rate(message, "ocr"):
+        return
     wait_msg = bot.send_message(message.chat.id, "⏳ جاري معالجة الصورة، يرجى الانتظار...")
     try:
         file_info = bot.get_file(message.photo[-1].file_id)
@@ -903,6 +3168,121 @@ def fallback_handler(message):
         return
     show_main_menu(message.chat.id, msg_only=False)
 
+# ===== توزيع التحديثات على العمال =====
+def update_chat_key(update):
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    call = update.callback_query
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    if update.chat_member is not None:
+        # نرتّب أحداث العضوية مع محادثة المستخدم الخاصة نفسها
+        return update.chat_member.new_chat_member.user.id
+    if update.my_chat_member is not None:
+        return update.my_chat_member.chat.id
+    return update.update_id
+
+class UpdateDispatcher:
+    # كل محادثة تُربط بعامل واحد ثابت، فتبقى تحديثاتها بالترتيب
+    # بينما تُعالج المحادثات المختلفة بالتوازي.
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"update-worker-{i}", daemon=True).start()
+
+    def submit(self, update):
+        q = self.queues[hash(update_chat_key(update)) % len(self.queues)]
+        if update.chat_member is not None:
+            # أحداث العضوية لا تُسقط: تيليجرام لا يعيد إرسالها، وحدث مغادرة ضائع يعني
+            # عدم تطبيق حظر المغادرة. ننتظر مكاناً في الطابور (أحداث نادرة ولا رد للمستخدم)
+            q.put(update)
+            return True
+        try:
+            q.put_nowait(update)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            logging.warning("update queue full, dropping update %s", update.update_id)
+            return False
+
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            try:
+                bot.process_new_updates([update])
+                with self.lock:
+                    self.processed += 1
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                logging.exception("failed to process update %s", update.update_id)
+            finally:
+                q.task_done()
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        with self.lock:
+            return {
+                "workers": len(self.queues),
+                "queued": sum(depths),
+                "max_depth": max(depths),
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+class RecentUpdates:
+    # فهرس محدود لآخر update_id تم استلامها، لإسقاط ما يعيد تيليجرام إرساله
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id):
+        now = time.monotonic()
+        with self.lock:
+            seen_at = self.entries.get(update_id)
+            if seen_at is not None and now - seen_at < self.window:
+                self.duplicates += 1
+                return True
+            self.entries[update_id] = now
+            self.entries.move_to_end(update_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            while self.entries:
+                oldest_seen = next(iter(self.entries.values()))
+                if now - oldest_seen < self.window:
+                    break
+                self.entries.popitem(last=False)
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {"tracked": len(self.entries), "duplicates_dropped": self.duplicates}
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+recent_updates = RecentUpdates(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_SIZE)
+register_metrics("التحديثات", lambda: {**dispatcher.stats(), **recent_updates.stats()})
+
+def shed_response(update):
+    # عند امتلاء الطابور نُسقط التحديث ونرد برسالة "مشغول" ضمن رد الـ webhook
+    # نفسه، فلا نحتاج طلب API إضافي ولا يعيد تيليجرام الإرسال.
+    text = "⚠️ البوت مشغول حالياً، حاول مرة أخرى بعد قليل."
+    if update.callback_query is not None:
+        return jsonify(method="answerCallbackQuery", callback_query_id=update.callback_query.id, text=text)
+    if update.message is not None:
+        return jsonify(method="sendMessage", chat_id=update.message.chat.id, text=text)
+    return '', 200
+
 # ===== Webhook endpoints =====
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -910,10 +3290,14 @@ def webhook():
         json_string = request.get_data().decode('utf-8')
         try:
             update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
-            return '', 200
         except Exception:
-            return '', 500
+            logging.exception("invalid update payload")
+            return '', 200
+        if recent_updates.is_duplicate(update.update_id):
+            return '', 200
+        if not dispatcher.submit(update):
+            return shed_response(update)
+        return '', 200
     else:
         return '', 403
 
@@ -922,9 +3306,11 @@ def index():
     return "Webhook set!", 200
 
 if __name__ == '__main__':
+    # Render يرسل SIGTERM عند الإيقاف؛ الخروج النظامي يشغّل atexit فتُحفظ الكتابات المؤجلة
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         bot.remove_webhook()
-        bot.set_webhook(url=WEBHOOK_URL)
+        bot.set_webhook(url=WEBHOOK_URL, allowed_updates=["message", "callback_query", "chat_member"])
     except Exception as e:
         pass
     app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,204 @@
+# عمل yt-dlp و ffmpeg الذي يُنفَّذ داخل عمليات MediaProcessPool في bot.py.
+# لا يستورد شيئاً من bot حتى لا تلمس العمليات الفرعية تيليجرام أو قاعدة البيانات،
+# وكل دالة هنا تأخذ إعداداتها كوسائط وتعيد نتائج صغيرة قابلة للـ pickle (مسارات وقواميس).
+import os
+import re
+import math
+import time
+import shutil
+import signal
+import subprocess
+import multiprocessing
+from multiprocessing.reduction import send_handle
+import yt_dlp
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+
+# مفاتيح التقدم التي يحتاجها البوت لعرض الحالة، بدل قاموس yt-dlp الكامل
+PROGRESS_KEYS = ("status", "filename", "downloaded_bytes", "total_bytes", "total_bytes_estimate",
+                 "speed", "eta", "fragment_index", "fragment_count")
+PROGRESS_MIN_INTERVAL = 0.5 # ثواني بين رسالتي تقدم لنفس النسبة
+
+class DownloadTooLarge(Exception):
+    pass
+
+def format_size(fmt):
+    return fmt.get('filesize') or fmt.get('filesize_approx')
+
+def fit_formats(info, limit, action):
+    # نحذف الصيغ التي نعرف (أو نقدّر) أنها أكبر من الحد ليختار محدد الصيغة أفضل ما تبقى.
+    # نفضّل الصيغ معروفة الحجم حتى لا يقع الاختيار على صيغة مجهولة يوقفها ByteBudget
+    # بينما توجد صيغة مناسبة.
+    formats = info.get('formats')
+    if not formats:
+        return info
+    sized = [fmt for fmt in formats if format_size(fmt) and format_size(fmt) <= limit]
+    if action == "audio":
+        usable = any(fmt.get('acodec') != 'none' for fmt in sized)
+    else:
+        usable = any(fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none' for fmt in sized)
+    if usable:
+        info['formats'] = sized
+    else:
+        info['formats'] = [fmt for fmt in formats if not format_size(fmt) or format_size(fmt) <= limit]
+    return info
+
+class ByteBudget:
+    # progress hook يوقف التحميل بمجرد أن يتجاوز ما كُتب (لكل الملفات) الحد المسموح
+    def __init__(self, limit):
+        self.limit = limit
+        self.files = {}
+
+    def __call__(self, d):
+        if d.get('status') not in ('downloading', 'finished'):
+            return
+        total = d.get('total_bytes')
+        self.files[d.get('filename')] = d.get('downloaded_bytes') or 0
+        if sum(self.files.values()) > self.limit or (total and total > self.limit):
+            raise DownloadTooLarge(d.get('filename'))
+
+class ProgressRelay:
+    # progress hook يرسل تقدم التحميل إلى البوت؛ yt-dlp يستدعيه مع كل جزء صغير،
+    # فلا نرسل إلا عند تغير النسبة أو الحالة أو بعد فاصل قصير
+    def __init__(self, report):
+        self.report = report
+        self.last = None
+        self.sent_at = 0
+
+    def __call__(self, d):
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        percent = int((d.get('downloaded_bytes') or 0) * 100 / total) if total else None
+        now = time.monotonic()
+        state = (d.get('status'), percent)
+        if state == self.last and now - self.sent_at < PROGRESS_MIN_INTERVAL:
+            return
+        self.last = state
+        self.sent_at = now
+        self.report({key: d.get(key) for key in PROGRESS_KEYS})
+
+def extract_info(url, heavy_keys):
+    with yt_dlp.YoutubeDL({'quiet': True, 'noplaylist': True}) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True)
+    for key in heavy_keys:
+        info.pop(key, None)
+    return info
+
+def download(info, action, tmpdir, format_spec, postprocessors, byte_limit, report=None, source_limit=None):
+    # يعيد مسار الملف النهائي بعد المعالجة؛ امتداده يعتمد على ما إذا تم التحويل
+    # source_limit حد ما يُكتب من المصدر أثناء التحميل (افتراضياً byte_limit)
+    ydl_opts = {
+        'outtmpl': os.path.join(tmpdir, '%(title)s.%(ext)s'),
+        'format': format_spec,
+        'noplaylist': True,
+        'quiet': True,
+        'noprogress': True,
+        'progress_hooks': [],
+        'postprocessors': postprocessors,
+    }
+    ydl_opts['progress_hooks'].append(ByteBudget(source_limit or byte_limit))
+    if report is not None:
+        ydl_opts['progress_hooks'].append(ProgressRelay(report))
+    # info وصل عبر pickle فهو نسخة خاصة بهذه العملية ويمكن تعديله مباشرة
+    info = fit_formats(info, byte_limit, action)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+    return info['requested_downloads'][0]['filepath']
+
+def extract_audio(path, codec_mapping, quality):
+    # صوت من فيديو موجود محلياً بنفس قواعد التحويل المستخدمة عند التحميل
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        pp = FFmpegExtractAudioPP(ydl, preferredcodec=codec_mapping, preferredquality=quality)
+        _, info = pp.run({'filepath': path, 'ext': path.rsplit('.', 1)[-1]})
+    return info['filepath']
+
+def media_duration(pp, path):
+    # ffprobe إن وُجد، وإلا سطر Duration الذي يطبعه ffmpeg -i (بعض البيئات بدون ffprobe)
+    if pp.probe_available:
+        return pp._get_real_video_duration(path, fatal=False)
+    out = subprocess.run([pp.executable, '-hide_banner', '-i', path], capture_output=True, text=True, errors='replace').stderr
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", out)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def split_audio(path, duration, max_bytes, max_parts):
+    # تقسيم بالزمن إلى أجزاء متساوية بنسخ الترميز كما هو (بدون إعادة ترميز). الصوت متغير
+    # المعدل قد يجعل جزءاً أكبر من نصيبه، فنعيد التقسيم بجزء إضافي حتى تناسب كلها الحد.
+    # الثانية الزائدة لكل جزء تمنع أن يصير فرق المدة الحقيقية عن duration جزءاً صغيراً مستقلاً
+    base, ext = os.path.splitext(path)
+    parts = max(2, math.ceil(os.path.getsize(path) / max_bytes))
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        pp = FFmpegPostProcessor(ydl)
+        duration = duration or media_duration(pp, path)
+        if not duration:
+            raise DownloadTooLarge(path)
+        while parts <= max_parts:
+            out_dir = f"{base}.parts{parts}"
+            os.mkdir(out_dir)
+            pp.real_run_ffmpeg([(path, [])], [(os.path.join(out_dir, f"%03d{ext}"), [
+                '-map', '0:a', '-c', 'copy', '-f', 'segment',
+                '-segment_time', str(math.ceil(duration / parts) + 1), '-reset_timestamps', '1',
+            ])])
+            files = sorted(os.path.join(out_dir, name) for name in os.listdir(out_dir))
+            if len(files) <= max_parts and all(os.path.getsize(f) <= max_bytes for f in files):
+                return files
+            shutil.rmtree(out_dir, ignore_errors=True)
+            parts += 1
+    raise DownloadTooLarge(path)
+
+def worker_main(conn):
+    # حلقة العملية الفرعية: (الدالة، الوسائط) ← ("ok", النتيجة) أو ("error", الاستثناء)،
+    # مع رسائل ("progress", قاموس) أثناء التنفيذ للدوال التي تقبل report
+    def report(d):
+        conn.send(("progress", d))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args, kwargs, wants_progress = task
+        if wants_progress:
+            kwargs = dict(kwargs, report=report)
+        try:
+            conn.send(("ok", fn(*args, **kwargs)))
+        except Exception as e:
+            try:
+                conn.send(("error", e))
+            except Exception:
+                # استثناءات yt-dlp تحمل traceback لا يقبل الـ pickle
+                conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+def zygote_main(conn):
+    # عملية أحادية الخيط تبدأ قبل أي خيط في البوت، وكل عملية عمل تُنسخ (fork) منها هي.
+    # نسخ البوت نفسه أثناء عمل خيوطه قد يورّث العملية الجديدة قفلاً محجوزاً لا يُحرر أبداً.
+    # كل طلب ← عملية جديدة: يُرسل طرف اتصالها (file descriptor) ثم رقمها pid
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # النظام يحصد العمليات المنتهية تلقائياً
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            parent_conn.close()
+            # yt-dlp ينتظر ffmpeg بـ waitpid، وهذا لا يعمل مع SIG_IGN
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            code = 0
+            try:
+                worker_main(child_conn)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        child_conn.close()
+        send_handle(conn, parent_conn.fileno(), None)
+        parent_conn.close()
+        conn.send(pid)